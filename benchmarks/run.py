@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import fnmatch
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+from unittest import mock
+
+from sqlalchemy import insert
+
+from fakes import minio as fake_minio
+
+BASELINE_FP: str = os.path.join(os.path.dirname(__file__), "baseline.json")
+CHAT_PREFIX: str = "bench:"
+HISTORY_MESSAGES: int = 300
+INSERT_BATCH_SIZE: int = 1_000
+
+ANSWER: str = "Работаю маркетологом пять лет, последние два года руковожу командой из четырёх человек в e-commerce."
+QUESTION: str = (
+    "Спасибо! Расскажите, пожалуйста, подробнее о вашем опыте: какие каналы продвижения вы вели, "
+    "какими результатами гордитесь и с какими бюджетами приходилось работать?"
+)
+CV: dict = {
+    "full_name": "Анна Иванова",
+    "headline": "Marketing Manager",
+    "contacts": [
+        {"label": "Email", "value": "anna@example.com"},
+        {"label": "Phone", "value": "+380 67 000 00 00"},
+        {"label": "Location", "value": "Kyiv"},
+    ],
+    "summary": ANSWER * 2,
+    "sections": [
+        {
+            "title": "Experience",
+            "entries": [
+                {
+                    "title": f"Company {i}",
+                    "subtitle": "Marketing Manager",
+                    "period": f"{2015 + i} - {2016 + i}",
+                    "bullets": [QUESTION[:80], ANSWER[:90], "Budget <$50k> & team of 4"],
+                }
+                for i in range(5)
+            ],
+        },
+        {"title": "Skills", "entries": [{"bullets": ["SEO", "PPC", "Analytics", "Email", "SMM", "Content"]}]},
+    ],
+}
+
+
+@dataclass
+class Result:
+    name: str
+    iterations: int
+    median_us: float
+    min_us: float
+
+
+@dataclass
+class Benchmark:
+    name: str
+    run: Callable[[], None]
+    iterations: int
+    setup: Optional[Callable[[], None]] = None
+
+
+def measure(benchmark: Benchmark, repeat: int) -> Result:
+    if benchmark.setup is not None:
+        benchmark.setup()
+    benchmark.run()
+
+    samples: list[float] = []
+    for __ in range(repeat):
+        if benchmark.setup is not None:
+            benchmark.setup()
+        started: float = time.perf_counter()
+        for __ in range(benchmark.iterations):
+            benchmark.run()
+        samples.append((time.perf_counter() - started) / benchmark.iterations * 1_000_000)
+
+    return Result(benchmark.name, benchmark.iterations, round(statistics.median(samples), 2), round(min(samples), 2))
+
+
+@contextlib.contextmanager
+def application(db_url: str) -> Iterator:
+    server = fake_minio.serve(fake_minio.MinioState()).start()
+    os.environ.update({"DB_URL": db_url, "MINIO_URL": server.url.split("://", 1)[1]})
+    for name in ("TG_API_TOKEN", "OPENAI_API_KEY", "CRM_API_KEY"):
+        os.environ.setdefault(name, "1:benchmark")
+
+    # main reads its settings and creates the schema on import
+    import main
+
+    try:
+        yield main
+    finally:
+        server.stop()
+
+
+class Fixtures:
+    def __init__(self, main):
+        from survey import db
+
+        self.main = main
+        self.db = db
+        self.my_db = main.my_db
+        self.params: list[str] = main.DEFAULT_PARAMS
+
+    def check_dedicated(self):
+        with self.my_db.Session() as session:
+            others: int = session.query(self.db.Users).filter(
+                self.db.Users.tg_chat_id.notlike(f"{CHAT_PREFIX}%")
+            ).count()
+        if others:
+            sys.exit(f"{others} real users found, run the benchmarks against a dedicated database")
+
+    def cleanup(self):
+        with self.my_db.Session() as session:
+            for model in (self.db.Message, self.db.TokenLedger, self.db.Users):
+                session.query(model).filter(model.tg_chat_id.like(f"{CHAT_PREFIX}%")).delete(synchronize_session=False)
+            session.commit()
+
+    def user_data(self, i: int, answered: Optional[int] = None) -> dict:
+        answered = len(self.params) if answered is None else answered
+        return {
+            "lang": "ru",
+            "vacancy": "Marketing Manager",
+            "resume": f"{CHAT_PREFIX}{i}.pdf",
+            "params": {str(index): f"{ANSWER[:40]} {i}" for index in range(answered)},
+        }
+
+    def add_users(self, start: int, stop: int):
+        now: datetime = datetime.now(timezone.utc)
+        with self.my_db.Session() as session:
+            for batch_start in range(start, stop, INSERT_BATCH_SIZE):
+                session.execute(insert(self.db.Users), [
+                    {
+                        "tg_chat_id": f"{CHAT_PREFIX}{i}",
+                        "tg_data": {self.db.TgParam.username.value: f"candidate_{i}"},
+                        "data": self.user_data(i),
+                        "lang": "ru",
+                        "params_updated_at": now,
+                    }
+                    for i in range(batch_start, min(stop, batch_start + INSERT_BATCH_SIZE))
+                ])
+            session.commit()
+
+    def add_chat(self, name: str, messages: int) -> str:
+        tg_chat_id: str = f"{CHAT_PREFIX}{name}"
+        with self.my_db.Session() as session:
+            session.add(self.db.Users(
+                tg_chat_id=tg_chat_id,
+                tg_data={self.db.TgParam.username.value: name},
+                data=self.user_data(0, answered=len(self.params) // 2),
+                lang="ru",
+            ))
+            session.commit()
+
+        history: list = []
+        for i in range(messages):
+            if i % 10 == 9:
+                history.append(self.db.new_message({
+                    "role": "tool", "content": "success", "tool_call_id": f"call_{i}", "name": "set_param"
+                }))
+            else:
+                history.append(self.db.new_message({"role": "assistant" if i % 2 else "user", "content": (
+                    f"{QUESTION} ({i})" if i % 2 else f"{ANSWER} ({i})"
+                )}))
+        for batch_start in range(0, len(history), INSERT_BATCH_SIZE):
+            self.my_db.add_messages(tg_chat_id, history[batch_start:batch_start + INSERT_BATCH_SIZE])
+
+        return tg_chat_id
+
+    def load_user(self, tg_chat_id: str):
+        from survey import survey
+
+        user = survey.UserSurvey(tg_chat_id, survey.Survey(self.params), self.my_db, self.main.START_TOKENS)
+        user.load()
+        return user
+
+
+def get_benchmarks(fixtures: Fixtures, user_counts: list[int]) -> Iterator[Benchmark]:
+    from survey import cv, utils
+
+    main = fixtures.main
+    prompt: str = main.BASE_PROMPT
+
+    history_chat: str = fixtures.add_chat("history", HISTORY_MESSAGES)
+    flush_chat: str = fixtures.add_chat("flush", 0)
+
+    def cold_turn():
+        user = fixtures.load_user(history_chat)
+        user.reserve_tokens(main.TOKENS_RESERVE)
+        main.get_question(user, prompt)
+        user.settle_tokens()
+
+    yield Benchmark("turn.cold", cold_turn, iterations=50)
+
+    warm = fixtures.load_user(history_chat)
+    warm.reserve_tokens(main.TOKENS_RESERVE)
+
+    def warm_turn():
+        warm.add_user_answer(ANSWER)
+        main.get_question(warm, prompt)
+
+    yield Benchmark("get_question.warm", warm_turn, iterations=500)
+
+    loaded = fixtures.load_user(history_chat)
+    loaded.get_history_window(main.LIMIT_HISTORY, main.LIMIT_HISTORY_TOKENS)
+    yield Benchmark("survey.get_params", loaded.get_params, iterations=10_000)
+    yield Benchmark("survey.set_param", lambda: loaded.set_param(1, ANSWER), iterations=10_000)
+    yield Benchmark(
+        "survey._add_message",
+        lambda: loaded._add_message({"role": "user", "content": ANSWER}),
+        iterations=2_000,
+        setup=loaded._pending_messages.clear,
+    )
+
+    flushed = fixtures.load_user(flush_chat)
+
+    def flush():
+        flushed.set_param(2, ANSWER)
+        flushed.add_user_answer(ANSWER)
+        flushed.flush()
+
+    yield Benchmark("survey.flush", flush, iterations=100)
+
+    params_text: str = "\n".join(fixtures.params * 10)
+    yield Benchmark(
+        "utils.extract_params_from_text", lambda: utils.extract_params_from_text(params_text), iterations=10_000
+    )
+    yield Benchmark("cv.render_html", lambda: cv.render_html(CV, "en"), iterations=1_000)
+
+    from survey import pdf
+
+    if importlib.util.find_spec("weasyprint") is not None:
+        html: str = cv.render_html(CV, "en")
+        pdf.get_pool()
+        yield Benchmark("pdf.render", lambda: pdf.render(html), iterations=20)
+    else:
+        print("skip pdf.render: weasyprint is not installed", file=sys.stderr)
+
+    users: int = 0
+    for count in sorted(user_counts):
+        fixtures.add_users(users, count)
+        users = count
+        yield Benchmark(
+            f"db.write_file.{count // 1000}k" if count % 1000 == 0 else f"db.write_file.{count}",
+            lambda: fixtures.my_db.write_file(io.StringIO(), fixtures.params, main.TG_PARAMS),
+            iterations=1,
+        )
+
+
+def compare(results: list[Result], baseline: dict, threshold: float) -> list[str]:
+    regressions: list[str] = []
+    for result in results:
+        before: Optional[dict] = baseline.get("results", {}).get(result.name)
+        if before is None:
+            print(f"{result.name:<34}{result.median_us:>14.2f}{'':>14}{'new':>10}")
+            continue
+
+        change: float = result.median_us / before["median_us"] - 1
+        print(f"{result.name:<34}{result.median_us:>14.2f}{before['median_us']:>14.2f}{change:>+10.1%}")
+        if change > threshold:
+            regressions.append(result.name)
+
+    return regressions
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Per-turn hot path microbenchmarks against a dedicated postgres (DB_URL), "
+                    "fixtures are created and removed by the run"
+    )
+    parser.add_argument("--db-url", default=os.environ.get("DB_URL"), required="DB_URL" not in os.environ)
+    parser.add_argument("--only", help="fnmatch pattern of benchmark names, e.g. 'survey.*'")
+    parser.add_argument("--repeat", type=int, default=5, help="timed rounds per benchmark, the median is reported")
+    parser.add_argument("--users", default="10000,100000", help="user counts for the export benchmarks")
+    parser.add_argument("--baseline", default=BASELINE_FP)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression")
+
+    args = parser.parse_args()
+
+    with application(args.db_url) as main:
+        fixtures = Fixtures(main)
+        fixtures.check_dedicated()
+        fixtures.cleanup()
+
+        results: list[Result] = []
+        # the completion itself is not part of the measured cost, only what is built around it
+        with mock.patch("survey.gpt.GPT.get_question", return_value=(QUESTION, None, 150)):
+            try:
+                for benchmark in get_benchmarks(fixtures, [int(count) for count in args.users.split(",")]):
+                    if args.only and not fnmatch.fnmatch(benchmark.name, args.only):
+                        continue
+                    results.append(measure(benchmark, args.repeat))
+            finally:
+                fixtures.cleanup()
+
+    baseline: dict = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    print(f"{'benchmark':<34}{'median us':>14}{'baseline us':>14}{'change':>10}")
+    regressions: list[str] = compare(results, baseline, args.threshold)
+
+    if args.save:
+        merged: dict = baseline.get("results", {}) | {result.name: asdict(result) for result in results}
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": dict(sorted(merged.items())),
+            }, file, indent=2)
+            file.write("\n")
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        sys.exit(f"slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,127 @@
+import argparse
+import itertools
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from fakes.server import FakeServer, JSONHandler, parse_form
+
+CANDIDATES_PATH: str = "/recruitment/candidates"
+CANDIDATE_PATH_RE = re.compile(rf"^{CANDIDATES_PATH}/(\d+)$")
+
+
+@dataclass
+class CRMState:
+    api_key: Optional[str] = None
+    rate_limit: Optional[float] = None
+    latency: float = 0.0
+    candidates: dict[int, dict] = field(default_factory=dict)
+    requests: int = 0
+    throttled: int = 0
+
+    _ids: itertools.count = field(default_factory=lambda: itertools.count(1))
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _window: list[float] = field(default_factory=list)
+
+    def admit(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return True
+
+            now: float = time.monotonic()
+            self._window = [at for at in self._window if now - at < 1.0]
+            if len(self._window) >= self.rate_limit:
+                self.throttled += 1
+                return False
+
+            self._window.append(now)
+            return True
+
+    def create(self, fields: dict) -> int:
+        with self._lock:
+            candidate_id: int = next(self._ids)
+            self.candidates[candidate_id] = fields
+            return candidate_id
+
+    def update(self, candidate_id: int, fields: dict) -> bool:
+        with self._lock:
+            if candidate_id not in self.candidates:
+                return False
+            self.candidates[candidate_id] |= fields
+            return True
+
+
+class CRMHandler(JSONHandler):
+    state: CRMState = CRMState()
+
+    def do_POST(self):
+        if self._reject():
+            return
+
+        if self.path != CANDIDATES_PATH:
+            return self.send_json(404, {"error": "not found"})
+
+        candidate_id: int = self.state.create(self._read_form())
+        self.send_json(201, {"data": {"id": candidate_id}})
+
+    def do_PUT(self):
+        if self._reject():
+            return
+
+        match = CANDIDATE_PATH_RE.match(self.path)
+        if match is None or not self.state.update(int(match.group(1)), self._read_form()):
+            return self.send_json(404, {"error": "not found"})
+
+        self.send_json(200, {"data": {"id": int(match.group(1))}})
+
+    def do_GET(self):
+        match = CANDIDATE_PATH_RE.match(self.path)
+        candidate: Optional[dict] = None if match is None else self.state.candidates.get(int(match.group(1)))
+        if candidate is None:
+            return self.send_json(404, {"error": "not found"})
+
+        self.send_json(200, {"data": {"id": int(match.group(1))} | candidate})
+
+    def _reject(self) -> bool:
+        if self.state.api_key is not None and self.headers.get("X-API-KEY") != self.state.api_key:
+            self.read_body()
+            self.send_json(401, {"error": "unauthorized"})
+            return True
+
+        if not self.state.admit():
+            self.read_body()
+            self.send_json(429, {"error": "too many requests"}, {"Retry-After": "1"})
+            return True
+
+        time.sleep(self.state.latency)
+        return False
+
+    def _read_form(self) -> dict:
+        return parse_form(self.headers.get("Content-Type", ""), self.read_body())
+
+
+def serve(state: CRMState, host: str = "127.0.0.1", port: int = 0) -> FakeServer:
+    handler: type[CRMHandler] = type("BoundCRMHandler", (CRMHandler,), {"state": state})
+    return FakeServer(handler, host, port)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Local stand-in for the PeopleForce candidates API, use as CRM_URL")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--api-key", help="reject requests with another X-API-KEY")
+    parser.add_argument("--rate-limit", type=float, help="requests per second, the rest get 429 with Retry-After")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+
+    args = parser.parse_args()
+
+    server: FakeServer = serve(CRMState(args.api_key, args.rate_limit, args.latency), args.host, args.port)
+    print(f"fake crm listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    cli()
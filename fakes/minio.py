@@ -0,0 +1,113 @@
+import argparse
+import collections
+import hashlib
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from fakes.server import FakeServer, JSONHandler
+
+LOCATION_XML: bytes = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">us-east-1</LocationConstraint>'
+)
+
+
+@dataclass
+class MinioState:
+    latency: float = 0.0
+    buckets: set[str] = field(default_factory=set)
+    objects: dict[tuple[str, str], bytes] = field(default_factory=dict)
+    bytes_in: int = 0
+    bytes_out: int = 0
+    calls: collections.Counter = field(default_factory=collections.Counter)
+
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def count(self, operation: str, bytes_in: int = 0, bytes_out: int = 0):
+        with self._lock:
+            self.calls[operation] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+
+class MinioHandler(JSONHandler):
+    # only the single-part object calls the bot makes, requests are not authenticated
+    state: MinioState = MinioState()
+
+    def do_HEAD(self):
+        bucket, key, __ = self._target()
+        exists: bool = bucket in self.state.buckets if key is None else (bucket, key) in self.state.objects
+        self.state.count("head")
+        self.send_response(200 if exists else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self._target()
+        time.sleep(self.state.latency)
+
+        if key is None and "location" in query:
+            self.state.count("get_location")
+            return self.send_bytes(200, LOCATION_XML, "application/xml")
+
+        data: Optional[bytes] = self.state.objects.get((bucket, key))
+        if data is None:
+            self.state.count("get_missing")
+            return self._not_found(key)
+
+        self.state.count("get", bytes_out=len(data))
+        self.send_bytes(200, data, "application/octet-stream", {"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+    def do_PUT(self):
+        bucket, key, query = self._target()
+        data: bytes = self.read_body()
+        time.sleep(self.state.latency)
+
+        if key is None:
+            self.state.buckets.add(bucket)
+            self.state.count("make_bucket")
+            return self.send_bytes(200, b"", "application/xml")
+
+        if "uploadId" in query:
+            return self.send_bytes(501, b"multipart uploads are not supported", "text/plain")
+
+        self.state.objects[(bucket, key)] = data
+        self.state.count("put", bytes_in=len(data))
+        self.send_bytes(200, b"", "application/xml", {"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+    def _target(self) -> tuple[str, Optional[str], dict]:
+        url = urlsplit(self.path)
+        bucket, __, key = unquote(url.path).lstrip("/").partition("/")
+        return bucket, key or None, parse_qs(url.query, keep_blank_values=True)
+
+    def _not_found(self, key: Optional[str]):
+        body: bytes = (
+            '<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code>'
+            f'<Message>not found</Message><Key>{key}</Key></Error>'
+        ).encode()
+        self.send_bytes(404, body, "application/xml")
+
+
+def serve(state: MinioState, host: str = "127.0.0.1", port: int = 0) -> FakeServer:
+    handler: type[MinioHandler] = type("BoundMinioHandler", (MinioHandler,), {"state": state})
+    return FakeServer(handler, host, port)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="In-memory stand-in for the MinIO calls of the bot, use as MINIO_URL")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every object call")
+
+    args = parser.parse_args()
+
+    server: FakeServer = serve(MinioState(args.latency), args.host, args.port)
+    print(f"fake minio listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,148 @@
+import argparse
+import collections
+import itertools
+import json
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import urlsplit
+
+from fakes.server import FakeServer, JSONHandler
+
+COMPLETIONS_PATH: str = "/v1/chat/completions"
+UNANSWERED_PARAM_RE = re.compile(r"^\[(\d+)\] - .* - \? \(need to ask\)$", re.MULTILINE)
+
+
+@dataclass
+class OpenAIState:
+    latency: float = 0.0
+    completions: collections.Counter = field(default_factory=collections.Counter)
+    tokens: int = 0
+
+    _ids: itertools.count = field(default_factory=lambda: itertools.count(1))
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, tool: Optional[str], tokens: int) -> int:
+        with self._lock:
+            self.completions[tool or "text"] += 1
+            self.tokens += tokens
+            return next(self._ids)
+
+
+def reply(request: dict) -> tuple[Optional[str], list[dict]]:
+    messages: list[dict] = request["messages"]
+    tools: dict[str, dict] = {tool["function"]["name"]: tool["function"] for tool in request.get("tools") or []}
+
+    if "set_param" in tools:
+        # the interview: every user answer fills the first unanswered param, then the next question is asked
+        unanswered: list[str] = UNANSWERED_PARAM_RE.findall(messages[0]["content"])
+        if messages[-1]["role"] == "user" and unanswered:
+            return None, [_call("set_param", {"index": int(unanswered[0]), "value": messages[-1]["content"]})]
+        return f"Question {len(messages)}: tell me more?", []
+
+    if "send_to_crm" in tools:
+        return None, [_call("send_to_crm", {"full_name": "Load Test", "skills": ["python"]})]
+
+    if "set_crm_mapping" in tools:
+        indexes: list[int] = tools["set_crm_mapping"]["parameters"]["properties"]["mapping"]["items"][
+            "properties"]["index"]["enum"]
+        return None, [_call("set_crm_mapping", {"mapping": [{"index": i, "field": "none"} for i in indexes]})]
+
+    if "save_cv" in tools:
+        if "cv_html" in tools["save_cv"]["parameters"]["properties"]:
+            return None, [_call("save_cv", {"cv_html": "<html><body><h1>Load Test</h1></body></html>"})]
+        return None, [_call("save_cv", {
+            "full_name": "Load Test",
+            "headline": "Engineer",
+            "contacts": [{"label": "Email", "value": "load@test.local"}],
+            "summary": "Synthetic candidate.",
+            "sections": [{"title": "Skills", "entries": [{"bullets": ["python", "sql"]}]}],
+        })]
+
+    return "ok", []
+
+
+def _call(name: str, arguments: dict) -> dict:
+    return {"type": "function", "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)}}
+
+
+class OpenAIHandler(JSONHandler):
+    state: OpenAIState = OpenAIState()
+
+    def do_POST(self):
+        if urlsplit(self.path).path != COMPLETIONS_PATH:
+            self.read_body()
+            return self.send_json(404, {"error": {"message": "not found"}})
+
+        request: dict = json.loads(self.read_body())
+        content, calls = reply(request)
+
+        prompt_tokens: int = sum(len(str(message.get("content") or "")) // 4 for message in request["messages"])
+        completion_tokens: int = len(content or "") // 4 + sum(
+            len(call["function"]["arguments"]) // 4 for call in calls
+        )
+        usage: dict = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        completion_id: int = self.state.record(calls[0]["function"]["name"] if calls else None, usage["total_tokens"])
+        for index, call in enumerate(calls):
+            call["id"] = f"call_{completion_id}_{index}"
+
+        time.sleep(self.state.latency)
+
+        base: dict = {"id": f"chatcmpl-{completion_id}", "created": int(time.time()), "model": request["model"]}
+        message: dict = {"role": "assistant", "content": content}
+        if calls:
+            message["tool_calls"] = calls
+        finish_reason: str = "tool_calls" if calls else "stop"
+
+        if not request.get("stream"):
+            return self.send_json(200, base | {
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+                "usage": usage,
+            })
+
+        delta: dict = message | {"tool_calls": [call | {"index": i} for i, call in enumerate(calls)]} if calls \
+            else message
+        chunks: list[dict] = [
+            {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]},
+            {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]},
+        ]
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunks.append({"choices": [], "usage": usage})
+
+        body: str = "".join(
+            f"data: {json.dumps(base | {'object': 'chat.completion.chunk'} | chunk, ensure_ascii=False)}\n\n"
+            for chunk in chunks
+        ) + "data: [DONE]\n\n"
+        self.send_bytes(200, body.encode("utf-8"), "text/event-stream")
+
+
+def serve(state: OpenAIState, host: str = "127.0.0.1", port: int = 0) -> FakeServer:
+    handler: type[OpenAIHandler] = type("BoundOpenAIHandler", (OpenAIHandler,), {"state": state})
+    return FakeServer(handler, host, port)
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for OpenAI chat completions, use OPENAI_BASE_URL=<url>/v1"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every completion")
+
+    args = parser.parse_args()
+
+    server: FakeServer = serve(OpenAIState(args.latency), args.host, args.port)
+    print(f"fake openai listening on {server.url}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    cli()
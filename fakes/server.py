@@ -0,0 +1,92 @@
+import email.parser
+import email.policy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+
+def parse_form(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return dict(parse_qsl(body.decode("utf-8")))
+
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    if not message.is_multipart():
+        return {}
+
+    fields: dict = {}
+    for part in message.iter_parts():
+        name: str = part.get_param("name", header="content-disposition")
+        filename: Optional[str] = part.get_filename()
+        data: bytes = part.get_payload(decode=True)
+        value = {"filename": filename, "size": len(data)} if filename else data.decode("utf-8")
+
+        if name.endswith("[]"):
+            fields.setdefault(name[:-2], []).append(value)
+        else:
+            fields[name] = value
+
+    return fields
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def read_params(self) -> dict:
+        params: dict = dict(parse_qsl(urlsplit(self.path).query))
+        body: bytes = self.read_body()
+        if body:
+            params |= parse_form(self.headers.get("Content-Type", ""), body)
+        return params
+
+    def send_bytes(self, status: int, body: bytes, content_type: str, headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, data: Optional[dict] = None, headers: Optional[dict] = None):
+        body: bytes = b"" if data is None else json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_bytes(status, body, "application/json", headers)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+    def __init__(self, handler: type[BaseHTTPRequestHandler], host: str = "127.0.0.1", port: int = 0):
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,165 @@
+import argparse
+import collections
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from fakes.server import FakeServer, JSONHandler
+
+WEBHOOK_PATH: str = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET: str = os.environ.get("WEBHOOK_SECRET", "")
+
+API_PATH_RE = re.compile(r"^/bot[^/]+/(\w+)$")
+FILE_PATH_RE = re.compile(r"^/file/bot[^/]+/(.+)$")
+MESSAGE_METHODS: set[str] = {"sendMessage", "editMessageText", "sendDocument", "sendPhoto", "editMessageReplyMarkup"}
+
+_update_ids = itertools.count(int(time.time() * 1000))
+
+
+def fake_update(chat_id: int, text: Optional[str] = None, callback_data: Optional[str] = None,
+                username: Optional[str] = None, update_id: Optional[int] = None,
+                document: Optional[dict] = None, reply_to: Optional[dict] = None) -> dict:
+    chat: dict = {"id": chat_id, "type": "private", "username": username}
+    user: dict = {"id": chat_id, "is_bot": False, "first_name": username or str(chat_id), "username": username}
+    message: dict = {"message_id": 1, "date": int(time.time()), "chat": chat, "from": user}
+
+    update: dict = {"update_id": next(_update_ids) if update_id is None else update_id}
+    if callback_data is None:
+        entities: list[dict] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] \
+            if text and text.startswith("/") else []
+        update["message"] = message | ({"document": document} if document else {"text": text, "entities": entities})
+    else:
+        bot_message: dict = message | {"text": "", "from": user | {"is_bot": True}}
+        if reply_to is not None:
+            bot_message["reply_to_message"] = reply_to
+        update["callback_query"] = {
+            "id": str(update["update_id"]), "from": user, "chat_instance": str(chat_id),
+            "message": bot_message, "data": callback_data,
+        }
+
+    return update
+
+
+def fake_document(file_id: str, file_name: str = "resume.pdf", file_size: int = 100_000) -> dict:
+    return {
+        "file_id": file_id, "file_unique_id": file_id, "file_name": file_name,
+        "mime_type": "application/pdf", "file_size": file_size,
+    }
+
+
+@dataclass
+class BotAPIState:
+    latency: float = 0.0
+    file_size: int = 100_000
+    calls: collections.Counter = field(default_factory=collections.Counter)
+
+    _message_ids: itertools.count = field(default_factory=lambda: itertools.count(1000))
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def call(self, method: str) -> int:
+        with self._lock:
+            self.calls[method] += 1
+            return next(self._message_ids)
+
+
+class BotAPIHandler(JSONHandler):
+    state: BotAPIState = BotAPIState()
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        path: str = urlsplit(self.path).path
+        time.sleep(self.state.latency)
+
+        if FILE_PATH_RE.match(path):
+            self.read_body()
+            self.state.call("downloadFile")
+            body: bytes = b"%PDF-1.4\n" + b"0" * max(self.state.file_size - 9, 0)
+            return self.send_bytes(200, body, "application/octet-stream")
+
+        api_match = API_PATH_RE.match(path)
+        if api_match is None:
+            self.read_body()
+            return self.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+        method: str = api_match.group(1)
+        params: dict = self.read_params()
+        message_id: int = self.state.call(method)
+        self.send_json(200, {"ok": True, "result": self._result(method, params, message_id)})
+
+    def _result(self, method: str, params: dict, message_id: int):
+        if method in MESSAGE_METHODS:
+            chat_id: int = int(params.get("chat_id", 0))
+            return {
+                "message_id": int(params.get("message_id", message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        if method == "getFile":
+            file_id: str = params["file_id"]
+            return {
+                "file_id": file_id, "file_unique_id": file_id,
+                "file_size": self.state.file_size, "file_path": f"documents/{file_id}.pdf",
+            }
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+        return True
+
+
+def serve(state: BotAPIState, host: str = "127.0.0.1", port: int = 0) -> FakeServer:
+    handler: type[BotAPIHandler] = type("BoundBotAPIHandler", (BotAPIHandler,), {"state": state})
+    return FakeServer(handler, host, port)
+
+
+def send_update(url: str, update: dict) -> int:
+    response = requests.post(
+        url,
+        data=json.dumps(update),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+    )
+    return response.status_code
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Post synthetic telegram updates to a running webhook or serve a stand-in bot api"
+    )
+    parser.add_argument("chat_id", type=int, nargs="?")
+    parser.add_argument("--text")
+    parser.add_argument("--callback-data")
+    parser.add_argument("--username")
+    parser.add_argument("--update-id", type=int, help="reuse to check that a redelivered update is skipped")
+    parser.add_argument("--url", default=f"http://localhost:8080{WEBHOOK_PATH}")
+    parser.add_argument("--serve-port", type=int, help="serve the bot api on this port instead, use as TG_API_URL")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every served bot api call")
+
+    args = parser.parse_args()
+
+    if args.serve_port is not None:
+        server: FakeServer = serve(BotAPIState(args.latency), port=args.serve_port)
+        print(f"fake bot api listening on {server.url}")
+        server.serve_forever()
+        return
+
+    if args.chat_id is None:
+        parser.error("chat_id is required to post an update")
+
+    update: dict = fake_update(args.chat_id, args.text, args.callback_data, args.username, args.update_id)
+    print(send_update(args.url, update))
+
+
+if __name__ == '__main__':
+    cli()
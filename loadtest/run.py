@@ -0,0 +1,226 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from fakes import crm as fake_crm, minio as fake_minio, openai as fake_openai, telegram as fake_telegram
+from fakes.server import FakeServer
+
+PERCENTILES: tuple[int, ...] = (50, 95, 99)
+
+
+@dataclass
+class Turn:
+    step: str
+    seconds: float
+    queries: int
+    error: bool
+
+
+class QueryCounter:
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        # every engine in the process: the bot pool and the worker pool used by the eager tasks
+        event.listen(Engine, "before_cursor_execute", self._on_execute)
+
+    def take(self) -> int:
+        count: int = getattr(self._local, "count", 0)
+        self._local.count = 0
+        return count
+
+    def _on_execute(self, *args, **kwargs):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+
+def get_rss_bytes() -> int:
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values: list[float], percent: int) -> float:
+    ordered: list[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+def conversation(chat_id: int, vacancy_id: int, answers: int) -> list[tuple[str, dict]]:
+    username: str = f"load_{chat_id}"
+    document: dict = fake_telegram.fake_update(
+        chat_id, username=username, document=fake_telegram.fake_document(f"resume-{chat_id}")
+    )
+
+    return [
+        ("start", fake_telegram.fake_update(chat_id, "/start", username=username)),
+        ("set_lang", fake_telegram.fake_update(chat_id, callback_data="set_lang:en", username=username)),
+        ("set_vacancy", fake_telegram.fake_update(
+            chat_id, callback_data=f"set_vacancy:{vacancy_id}", username=username
+        )),
+        ("document", document),
+        ("accept_document", fake_telegram.fake_update(
+            chat_id, callback_data="accept_document", username=username, reply_to=document["message"]
+        )),
+        *[
+            ("answer", fake_telegram.fake_update(chat_id, f"answer {i} from {chat_id}", username=username))
+            for i in range(answers)
+        ],
+        ("finish", fake_telegram.fake_update(chat_id, callback_data="finish", username=username)),
+    ]
+
+
+def start_fakes(args) -> dict[str, tuple[FakeServer, object]]:
+    servers: dict[str, tuple[FakeServer, object]] = {}
+    for name, module, state in (
+            ("telegram", fake_telegram, fake_telegram.BotAPIState(args.telegram_latency)),
+            ("openai", fake_openai, fake_openai.OpenAIState(args.openai_latency)),
+            ("minio", fake_minio, fake_minio.MinioState(args.minio_latency)),
+            ("crm", fake_crm, fake_crm.CRMState(latency=args.crm_latency)),
+    ):
+        servers[name] = module.serve(state).start(), state
+
+    os.environ.update({
+        "TG_API_TOKEN": "1:loadtest",
+        "TG_API_URL": servers["telegram"][0].url,
+        "OPENAI_API_KEY": "loadtest",
+        "OPENAI_BASE_URL": f"{servers['openai'][0].url}/v1",
+        "MINIO_URL": servers["minio"][0].url.split("://", 1)[1],
+        "CRM_URL": servers["crm"][0].url,
+        "CRM_API_KEY": "loadtest",
+    })
+    return servers
+
+
+def run(args) -> dict:
+    servers = start_fakes(args)
+
+    # the application reads its settings on import, after the fakes are in the environment
+    import main
+    from survey.celery import app
+
+    app.conf.task_always_eager = args.eager_tasks
+
+    if not main.my_db.get_vacancies():
+        main.my_db.sync_vacancies(["Load test vacancy"])
+    vacancy_id: int = main.my_db.get_vacancies()[0].id
+
+    answers: int = args.answers if args.answers is not None else len(main.config_cache.get()[0]) + 1
+    bot = main.create_bot()
+    queries = QueryCounter()
+    queries.install()
+
+    from telebot import types
+
+    def play(chat_id: int) -> list[Turn]:
+        turns: list[Turn] = []
+        for step, update in conversation(chat_id, vacancy_id, answers):
+            parsed: types.Update = types.Update.de_json(json.dumps(update))
+            queries.take()
+            started: float = time.perf_counter()
+            try:
+                bot.process_new_updates([parsed])
+                error = False
+            except Exception:
+                logging.exception(f"{step} failed for {chat_id=}")
+                error = True
+            turns.append(Turn(step, time.perf_counter() - started, queries.take(), error))
+            time.sleep(args.think_time)
+        return turns
+
+    first_chat_id: int = args.first_chat_id or int(time.time() * 1000)
+    rss_before: int = get_rss_bytes()
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="chat") as executor:
+        results: list[list[Turn]] = list(executor.map(play, range(first_chat_id, first_chat_id + args.chats)))
+    elapsed: float = time.perf_counter() - started
+    rss_after: int = get_rss_bytes()
+
+    for server, __ in servers.values():
+        server.stop()
+
+    turns: list[Turn] = [turn for chat in results for turn in chat]
+    return {
+        "chats": args.chats,
+        "concurrency": args.concurrency,
+        "turns": len(turns),
+        "errors": sum(turn.error for turn in turns),
+        "seconds": round(elapsed, 3),
+        "turns_per_second": round(len(turns) / elapsed, 2),
+        "chats_per_second": round(args.chats / elapsed, 3),
+        "latency_ms": _summary([turn.seconds * 1000 for turn in turns]),
+        "db_queries_per_turn": round(sum(turn.queries for turn in turns) / len(turns), 2),
+        "rss_growth_per_chat_kb": round((rss_after - rss_before) / args.chats / 1024, 1),
+        "steps": {
+            step: _summary([turn.seconds * 1000 for turn in turns if turn.step == step]) | {
+                "db_queries": round(
+                    sum(turn.queries for turn in turns if turn.step == step)
+                    / sum(1 for turn in turns if turn.step == step), 2
+                ),
+            }
+            for step in dict.fromkeys(turn.step for turn in turns)
+        },
+        "fakes": {
+            "telegram_calls": dict(servers["telegram"][1].calls),
+            "openai_completions": dict(servers["openai"][1].completions),
+            "openai_tokens": servers["openai"][1].tokens,
+            "minio_bytes_in": servers["minio"][1].bytes_in,
+            "minio_bytes_out": servers["minio"][1].bytes_out,
+            "crm_requests": servers["crm"][1].requests,
+        },
+    }
+
+
+def _summary(values: list[float]) -> dict:
+    return {"count": len(values)} | {f"p{p}": round(percentile(values, p), 1) for p in PERCENTILES}
+
+
+def print_report(report: dict):
+    print(
+        f"{report['chats']} chats x {report['turns'] // report['chats']} turns, concurrency {report['concurrency']}: "
+        f"{report['seconds']}s, {report['turns_per_second']} turns/s, {report['errors']} errors"
+    )
+    print(f"db queries per turn: {report['db_queries_per_turn']}, rss growth per chat: "
+          f"{report['rss_growth_per_chat_kb']} KiB")
+    print(f"{'step':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}")
+    for step, summary in [("all", report["latency_ms"] | {"db_queries": report["db_queries_per_turn"]}),
+                          *report["steps"].items()]:
+        print(f"{step:<16}{summary['count']:>8}{summary['p50']:>10}{summary['p95']:>10}{summary['p99']:>10}"
+              f"{summary['db_queries']:>10}")
+    print(json.dumps(report["fakes"], ensure_ascii=False))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic interviews through the bot handlers against local stand-ins for Telegram, "
+                    "OpenAI, MinIO and the CRM. Postgres (DB_URL) and Redis (CACHE_REDIS_URL) are real."
+    )
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10, help="conversations played at the same time")
+    parser.add_argument("--answers", type=int, help="interview answers per chat, default - params count + 1")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between turns of one chat")
+    parser.add_argument("--first-chat-id", type=int, help="default - derived from the current time")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--minio-latency", type=float, default=0.01)
+    parser.add_argument("--crm-latency", type=float, default=0.1)
+    parser.add_argument("--no-eager-tasks", dest="eager_tasks", action="store_false",
+                        help="send celery tasks to the broker instead of running them inside the turn")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+
+    args = parser.parse_args()
+
+    report: dict = run(args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
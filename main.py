@@ -1,14 +1,15 @@
 import logging
 import os
-import tempfile
+import time
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Callable
 
 import telebot
 from telebot import types
 from telebot.handler_backends import BaseMiddleware
 
-from survey import (db, gpt, survey, utils, storage)
+from survey import (cache, db, dispatcher, export, gpt, metrics, survey, tasks, utils, storage, tokenizer)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -28,14 +29,31 @@ DEFAULT_PARAMS: list[str] = utils.extract_params_from_text(
 HELP_TEXT: str = os.environ.get("HELP_TEXT", "START / HELP")
 
 LIMIT_HISTORY: int = int(os.environ.get("LIMIT_HISTORY", 7_000))
+LIMIT_HISTORY_TOKENS: int = int(os.environ.get("LIMIT_HISTORY_TOKENS", 3_000))
 START_TOKENS: int = int(os.environ.get("START_TOKENS", 50_000))
+TOKENS_RESERVE: int = int(os.environ.get("TOKENS_RESERVE", 16_000))
+
+STREAM_REPLIES: bool = os.environ.get("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL: float = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+
+EXPORT_ASYNC_THRESHOLD: int = int(os.environ.get("EXPORT_ASYNC_THRESHOLD", 5_000))
+
+BOT_WORKERS: int = int(os.environ.get("BOT_WORKERS", 100))
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", 20))
+POLLING_TIMEOUT: int = int(os.environ.get("POLLING_TIMEOUT", 20))
 
 TG_API_TOKEN: str = os.environ["TG_API_TOKEN"]
 TG_PARAMS: list[str] = ["username"]
 
 
-my_db = db.SQLAlchemy(DB_URL)
+my_db = db.SQLAlchemy(DB_URL, pool_size=DB_POOL_SIZE, max_overflow=BOT_WORKERS)
 my_db.create_db(DEFAULT_PARAMS, BASE_PROMPT)
+metrics.instrument_engine(my_db.engine)
+
+config_cache = cache.VersionedCache(cache.CONFIG_CHANNEL, my_db.get_config)
+my_db.config_listeners.append(config_cache.invalidate)
+# rebuilt only when the vacancy sync in the workers publishes a new version
+vacancies_cache = cache.VersionedCache(cache.VACANCIES_CHANNEL, lambda: get_vacancies_markup())
 
 minio = storage.MinioClient()
 minio.create_buckets()
@@ -60,7 +78,46 @@ class MyCallbackQuery(types.CallbackQuery, Mixin):
     pass
 
 
-def get_question(user_survey: survey.UserSurvey, prompt: str, counter: int = 0) -> str:
+class ReplyStreamer:
+    def __init__(self, tg_chat_id: int, bot: telebot.TeleBot, interval: float = STREAM_EDIT_INTERVAL):
+        self._tg_chat_id = tg_chat_id
+        self._bot = bot
+        self._interval = interval
+
+        self._message_id: Optional[int] = None
+        self._sent_text: str = ""
+        self._sent_at: float = 0.0
+
+    def __call__(self, text: str):
+        if not text.strip():
+            return
+
+        if self._message_id is None:
+            self._message_id = self._bot.send_message(self._tg_chat_id, text).message_id
+            self._sent_text, self._sent_at = text, time.monotonic()
+        elif time.monotonic() - self._sent_at >= self._interval:
+            self._edit(text)
+
+    def finish(self, text: str):
+        if self._message_id is None:
+            self._bot.send_message(self._tg_chat_id, text)
+        else:
+            self._edit(text)
+
+    def _edit(self, text: str):
+        if text == self._sent_text:
+            return
+
+        self._bot.edit_message_text(text, self._tg_chat_id, self._message_id)
+        self._sent_text, self._sent_at = text, time.monotonic()
+
+
+def get_question(
+        user_survey: survey.UserSurvey,
+        prompt: str,
+        counter: int = 0,
+        on_text: Optional[Callable[[str], None]] = None,
+) -> str:
     if counter >= 3:
         raise Exception("foo")
 
@@ -77,18 +134,16 @@ def get_question(user_survey: survey.UserSurvey, prompt: str, counter: int = 0)
 
     system_message: str = prompt.format(data="\n".join(params))
 
-    len_counter: int = len(system_message)
-
-    to_send_reversed: list[dict] = []
-    for message in user_survey.get_history()[::-1]:
-        len_counter += len(message["content"] or "")
-        if len_counter >= LIMIT_HISTORY:
-            break
-        to_send_reversed.append(message)
+    system: dict = {"role": gpt.GPT.Role.SYSTEM.value, "content": system_message}
+    history: survey.History = user_survey.get_history_window(
+        LIMIT_HISTORY - len(system_message),
+        LIMIT_HISTORY_TOKENS - tokenizer.message_tokens(system),
+    )
 
     question, callbacks, tokens = gpt.GPT.get_question(
-        [{"role": gpt.GPT.Role.SYSTEM.value, "content": system_message}, *to_send_reversed[::-1]],
-        indexes=list(range(len(user_survey.survey.params)))
+        [system, *history.messages],
+        indexes=list(range(len(user_survey.survey.params))),
+        on_text=on_text,
     )
 
     user_survey.deduct_tokens(tokens)
@@ -104,7 +159,7 @@ def get_question(user_survey: survey.UserSurvey, prompt: str, counter: int = 0)
         if without_answers < 0 and no_more_questions:
             user_survey.send_full_to_crm()
 
-        return get_question(user_survey, prompt, counter + 1)
+        return get_question(user_survey, prompt, counter + 1, on_text)
 
     if not question:
         raise Exception("Didn't get question from gpt api")
@@ -121,23 +176,32 @@ def process_chat(user_survey: survey.UserSurvey, prompt: str, tg_chat_id: int, u
         send_vacancies(tg_chat_id, user_survey.translate("vacancies"), bot)
         return
 
-    if user_survey.get_resume_key() is None:
+    # a resume still uploading counts as received
+    if user_survey.get_resume_key() is None and user_survey.get_pending_resume() is None:
         ask_about_resume(user_survey.translate, tg_chat_id, bot)
         return
 
-    if user_survey.get_tokens() < 1:
+    if not user_survey.reserve_tokens(TOKENS_RESERVE):
         logging.info(f"{tg_chat_id} no tokens")
         return
 
-    bot.send_chat_action(tg_chat_id, "typing")
+    try:
+        bot.send_chat_action(tg_chat_id, "typing")
+
+        user_survey.add_user_answer(user_text)
 
-    user_survey.add_user_answer(user_text)
+        streamer: Optional[ReplyStreamer] = ReplyStreamer(tg_chat_id, bot) if STREAM_REPLIES else None
 
-    question: str = get_question(user_survey, prompt)
+        question: str = get_question(user_survey, prompt, on_text=streamer)
+    finally:
+        user_survey.settle_tokens()
 
     user_survey.add_assistant_question(question)
 
-    bot.send_message(tg_chat_id, question)
+    if streamer is None:
+        bot.send_message(tg_chat_id, question)
+    else:
+        streamer.finish(question)
 
 
 def send_welcome(message: MyMessage, bot: telebot.TeleBot):
@@ -165,16 +229,20 @@ def set_language(call: MyCallbackQuery, bot: telebot.TeleBot):
 
 
 def export_csv(message: MyMessage, bot: telebot.TeleBot):
-    try:
-        with tempfile.NamedTemporaryFile(
-                mode='w', dir="./", encoding="utf-8-sig", delete=False, suffix=".csv"
-        ) as temp_file:
-            my_db.write_file(temp_file, message.config.params, TG_PARAMS)
+    fmt, incremental = export.parse_args(message.text.split()[1:])
 
-        with open(temp_file.name, "rb") as csv_file:
-            bot.send_document(message.chat.id, csv_file)
+    if export.count(my_db, fmt, incremental) > EXPORT_ASYNC_THRESHOLD:
+        tasks.export_users.delay(message.chat.id, message.config.params, TG_PARAMS, fmt.value, incremental)
+        bot.reply_to(message, message.user.translate("export_started"))
+        return
+
+    result: export.Export = export.export_users(my_db, message.config.params, TG_PARAMS, fmt, incremental)
+    try:
+        with open(result.path, "rb") as export_file:
+            bot.send_document(message.chat.id, export_file)
+        result.commit(my_db)
     finally:
-        os.remove(temp_file.name)
+        os.remove(result.path)
 
 
 def clear(message: MyMessage, bot: telebot.TeleBot):
@@ -225,20 +293,36 @@ def give_me_tokens(message: MyMessage, bot: telebot.TeleBot):
     bot.reply_to(message, message.user.translate("tokens_added"))
 
 
+def tokens_spent(message: MyMessage, bot: telebot.TeleBot):
+    total, total_users = my_db.get_token_spend()
+    last_day, last_day_users = my_db.get_token_spend(datetime.now(timezone.utc) - timedelta(days=1))
+
+    bot.send_message(
+        message.chat.id,
+        f"Tokens spent: {total} by {total_users} users\nLast 24 hours: {last_day} by {last_day_users} users"
+    )
+
+
 def answer(message: MyMessage, bot: telebot.TeleBot):
     process_chat(message.user, message.config.prompt, message.chat.id, message.text, bot)
 
 
 def send_vacancies(chat_id: int, text: str, bot: telebot.TeleBot):
+    bot.send_message(chat_id, text, reply_markup=vacancies_cache.get())
+
+
+def get_vacancies_markup() -> tuple[int, types.InlineKeyboardMarkup]:
+    version, vacancies = my_db.get_vacancies_versioned()
+
     markup = types.InlineKeyboardMarkup(row_width=1)
     buttons = list(
         map(
             lambda v: types.InlineKeyboardButton(text=v.name, callback_data=f"set_vacancy:{v.id}"),
-            my_db.get_vacancies()
+            vacancies
         )
     )
     markup.add(*buttons)
-    bot.send_message(chat_id, text, reply_markup=markup)
+    return version, markup
 
 
 def set_vacancy(call: MyCallbackQuery, bot: telebot.TeleBot):
@@ -299,7 +383,7 @@ def skip_send_resume(call: MyCallbackQuery, bot: telebot.TeleBot):
 
 
 def handle_document(message: MyMessage, bot: telebot.TeleBot):
-    if message.user.get_resume_key():
+    if message.user.get_resume_key() or message.user.get_pending_resume():
         return
 
     document = message.document
@@ -322,37 +406,26 @@ def handle_document(message: MyMessage, bot: telebot.TeleBot):
 def accept_document(call: MyCallbackQuery, bot: telebot.TeleBot):
     tg_chat_id: int = call.message.chat.id
 
+    if call.user.get_resume_key() or call.user.get_pending_resume():
+        return
+
     document_message = call.message.reply_to_message
     document = document_message.document
-    file_info = bot.get_file(document.file_id)
-    data = bot.download_file(file_info.file_path)
-
-    call.user.set_resume_key(
-        minio.save(
-            document.file_name,
-            data,
-            document_message.content_type,
-            document.file_size,
-        )
-    )
-    call.user.send_short_to_crm()
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton(
-            text=call.user.translate("confirm_create_new_resume"),
-            callback_data="confirm_create_new_resume"
-        )
+    # stored before the task is queued, the task clears it when the upload is done
+    call.user.set_pending_resume(document.file_id)
+    call.user.flush()
+
+    # the file is piped from telegram to minio by a worker, it replies to the chat when done
+    bot.edit_message_text(call.user.translate("resume_uploading"), tg_chat_id, call.message.id)
+    tasks.upload_resume.delay(
+        tg_chat_id,
+        call.message.id,
+        document.file_id,
+        document.file_name,
+        document.mime_type or "application/octet-stream",
+        document.file_size,
     )
-    markup.add(
-        types.InlineKeyboardButton(
-            text=call.user.translate("finish"),
-            callback_data="finish"
-        )
-    )
-
-    bot.delete_message(tg_chat_id, call.message.id)
-    bot.send_message(tg_chat_id, call.user.translate("ask_create_new_resume"), reply_markup=markup)
 
 
 def confirm_create_new_resume(call: MyCallbackQuery, bot: telebot.TeleBot):
@@ -375,29 +448,40 @@ class LangMiddleware(BaseMiddleware):
         self.update_types = ['message', 'callback_query']
     
     def pre_process(self, obj, data):
+        metrics.start_update()
+
         chat: types.Chat = obj.chat if isinstance(obj, types.Message) else obj.message.chat
         chat_id: int = chat.id
         username: Optional[str] = chat.username
         my_db.create_if_not_exist(str(chat_id), username)
 
-        params, prompt = my_db.get_params_and_prompt()
+        params, prompt = config_cache.get()
         obj.config = Config(params=params, prompt=prompt)
 
         obj.user = survey.UserSurvey(str(chat_id), survey.Survey(params), my_db, START_TOKENS)
+        if not obj.user.load():
+            # the row was removed behind the known users cache (e.g. /clear in another process)
+            my_db.create_if_not_exist(str(chat_id), username, force=True)
+            obj.user.load()
 
     def post_process(self, message, data, exception):
-        pass
+        user: Optional[survey.UserSurvey] = getattr(message, "user", None)
+        if user is not None:
+            user.flush()
 
+        metrics.finish_update()
 
-def main():
-    bot = telebot.TeleBot(TG_API_TOKEN, use_class_middlewares=True)
+
+def create_bot() -> telebot.TeleBot:
+    bot = telebot.TeleBot(TG_API_TOKEN, use_class_middlewares=True, threaded=False)
 
     bot.register_message_handler(send_welcome, commands=['help', 'start'], pass_bot=True)
-    bot.register_message_handler(export_csv, commands=["export_csv"], pass_bot=True)
+    bot.register_message_handler(export_csv, commands=["export_csv", "export"], pass_bot=True)
     bot.register_message_handler(clear, commands=["clear"], pass_bot=True)
     bot.register_message_handler(prompt_f, commands=["prompt"], pass_bot=True)
     bot.register_message_handler(params_f, commands=["params"], pass_bot=True)
     bot.register_message_handler(give_me_tokens, commands=["give_me_tokens"], pass_bot=True)
+    bot.register_message_handler(tokens_spent, commands=["tokens_spent"], pass_bot=True)
     bot.register_message_handler(handle_document, content_types=['document'], pass_bot=True)
     bot.register_message_handler(answer, func=lambda message: True, pass_bot=True)
     bot.register_callback_query_handler(
@@ -420,10 +504,48 @@ def main():
     )
     bot.register_callback_query_handler(finish, func=lambda call: call.data == "finish", pass_bot=True)
 
+    for handler in [*bot.message_handlers, *bot.callback_query_handlers]:
+        handler["function"] = metrics.timed_handler(handler["function"])
+
     bot.setup_middleware(LangMiddleware())
 
+    return bot
+
+
+def get_update_chat_id(update: types.Update) -> Optional[int]:
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+
+def run_polling(bot: telebot.TeleBot):
+    chats = dispatcher.KeyedDispatcher(lambda update: bot.process_new_updates([update]), BOT_WORKERS)
+
+    offset: Optional[int] = None
+    while True:
+        try:
+            updates: list[types.Update] = bot.get_updates(
+                offset=offset, timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT
+            )
+        except Exception:
+            logging.exception("Failed to get updates")
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            chat_id: Optional[int] = get_update_chat_id(update)
+            chats.submit(("update", update.update_id) if chat_id is None else chat_id, update)
+
+
+def main():
+    bot = create_bot()
+    metrics.serve(metrics.METRICS_PORT)
+
     logging.info("bot started")
-    bot.infinity_polling()
+    run_polling(bot)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+import redis
+
+CACHE_REDIS_URL: str = os.environ.get("CACHE_REDIS_URL", os.environ.get("BROKER_URL", "redis://redis:6379/0"))
+CACHE_TTL: float = float(os.environ.get("CACHE_TTL", 300))
+RESULT_CACHE_TTL: int = int(os.environ.get("RESULT_CACHE_TTL", 7 * 24 * 3600))
+
+CONFIG_CHANNEL: str = "survey:config"
+VACANCIES_CHANNEL: str = "survey:vacancies"
+
+T = TypeVar("T")
+
+
+class VersionedCache(Generic[T]):
+    def __init__(
+            self,
+            channel: str,
+            loader: Callable[[], tuple[int, T]],
+            ttl: float = CACHE_TTL,
+            redis_url: str = CACHE_REDIS_URL,
+    ):
+        self._channel = channel
+        self._loader = loader
+        self._ttl = ttl
+        self._redis = redis.Redis.from_url(redis_url)
+
+        self._lock = threading.Lock()
+        self._entry: Optional[tuple[int, T]] = None
+        self._loaded_at: float = 0.0
+        self._listener: Optional[threading.Thread] = None
+        self._listen_retry_at: float = 0.0
+
+    def get(self) -> T:
+        return self.get_versioned()[1]
+
+    def get_versioned(self) -> tuple[int, T]:
+        self._listen()
+
+        with self._lock:
+            if self._entry is None or time.monotonic() - self._loaded_at > self._ttl:
+                self._entry = self._loader()
+                self._loaded_at = time.monotonic()
+
+            return self._entry
+
+    def invalidate(self, version: Optional[int] = None):
+        self._drop()
+
+        try:
+            self._redis.publish(self._channel, "" if version is None else str(version))
+        except redis.RedisError:
+            logging.exception(f"Failed to broadcast {self._channel} invalidation, other processes wait for ttl")
+
+    def _drop(self):
+        with self._lock:
+            self._entry = None
+
+    def _listen(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+
+        if time.monotonic() < self._listen_retry_at:
+            return
+
+        try:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self._channel: self._on_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        except redis.RedisError:
+            logging.exception(f"Failed to subscribe to {self._channel}, falling back to ttl")
+            self._listen_retry_at = time.monotonic() + self._ttl
+            return
+
+        # anything published while we were not subscribed is lost
+        self._drop()
+
+    def _on_message(self, message: dict):
+        data: bytes = message["data"]
+        version: Optional[int] = int(data) if data else None
+
+        with self._lock:
+            if version is None or self._entry is None or self._entry[0] < version:
+                self._entry = None
+
+
+def fingerprint(*parts) -> str:
+    payload: str = json.dumps(_normalize(parts), ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache
+def file_fingerprint(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+class ResultCache:
+    def __init__(self, namespace: str, ttl: int = RESULT_CACHE_TTL, redis_url: str = CACHE_REDIS_URL):
+        self._namespace = namespace
+        self._ttl = ttl
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def get_or_create(self, key: str, create: Callable[[], Optional[bytes]]) -> Optional[bytes]:
+        name: str = f"{self._namespace}:{key}"
+
+        try:
+            value: Optional[bytes] = self._redis.get(name)
+        except redis.RedisError:
+            logging.exception(f"Failed to read {name}, computing the result")
+            return create()
+
+        if value is not None:
+            return value
+
+        value = create()
+        if value is not None:
+            try:
+                self._redis.set(name, value, ex=self._ttl)
+            except redis.RedisError:
+                logging.exception(f"Failed to store {name}")
+
+        return value
+
+    def get_or_create_json(self, key: str, create: Callable[[], Optional[Any]]) -> Optional[Any]:
+        def create_json() -> Optional[bytes]:
+            result = create()
+            return None if result is None else json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+        value: Optional[bytes] = self.get_or_create(key, create_json)
+        return None if value is None else json.loads(value)
@@ -2,7 +2,12 @@ import os
 
 from celery import Celery
 from celery.schedules import crontab
-from celery.signals import worker_ready
+from celery.signals import (
+    task_postrun, task_prerun, task_retry, worker_init, worker_process_init, worker_process_shutdown, worker_ready,
+    worker_shutdown
+)
+
+from . import metrics, pdf
 
 
 BROKER_URL = os.environ.get("BROKER_URL", "redis://redis:6379/0")
@@ -19,6 +24,10 @@ app.conf.update(
             'task': 'tasks.scrape_vacancies',
             'schedule': crontab(hour="0", minute="0")
         },
+        'prune-processed-updates-hourly': {
+            'task': 'survey.tasks.prune_processed_updates',
+            'schedule': crontab(minute="30")
+        },
     },
 )
 
@@ -30,3 +39,47 @@ def on_worker_ready(sender=None, **kwargs):
     from . import tasks
 
     tasks.scrape_vacancies.delay()
+
+
+@worker_init.connect
+def on_worker_init(sender=None, **kwargs):
+    from . import tasks
+
+    tasks.get_db()
+    # render processes start with the worker, not with the first CV
+    pdf.get_pool()
+
+    # the eventlet pool runs every task in this process, so one endpoint covers the worker
+    metrics.serve(metrics.METRICS_WORKER_PORT)
+    metrics.register_queues(BROKER_URL, [app.conf.task_default_queue])
+
+
+@worker_process_init.connect
+def on_worker_process_init(sender=None, **kwargs):
+    from . import tasks
+
+    tasks.reset_db_after_fork()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def on_worker_shutdown(sender=None, **kwargs):
+    from . import tasks
+
+    tasks.dispose_db()
+    pdf.close_pool()
+
+
+@task_prerun.connect
+def on_task_prerun(sender=None, task_id=None, **kwargs):
+    metrics.task_started(task_id)
+
+
+@task_postrun.connect
+def on_task_postrun(sender=None, task_id=None, state=None, **kwargs):
+    metrics.task_finished(task_id, sender.name, state)
+
+
+@task_retry.connect
+def on_task_retry(sender=None, **kwargs):
+    metrics.task_retried(sender.name)
@@ -0,0 +1,468 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+
+from survey import cache, db, gpt, multipart
+from survey.storage import MinioClient
+
+CRM_URL: str = os.environ.get("CRM_URL", "https://smarthr.peopleforce.io/api/public/v2").rstrip("/")
+CRM_API_KEY: str = os.environ["CRM_API_KEY"]
+CRM_TIMEOUT: float = float(os.environ.get("CRM_TIMEOUT", 30))
+CRM_MAX_CONNECTIONS: int = int(os.environ.get("CRM_MAX_CONNECTIONS", 10))
+CRM_RATE_LIMIT: float = float(os.environ.get("CRM_RATE_LIMIT", 2))
+CRM_RATE_BURST: int = int(os.environ.get("CRM_RATE_BURST", 5))
+CRM_MAX_WAIT: float = float(os.environ.get("CRM_MAX_WAIT", 10))
+CRM_COALESCE_DELAY: float = float(os.environ.get("CRM_COALESCE_DELAY", 5))
+CRM_PENDING_TTL: int = int(os.environ.get("CRM_PENDING_TTL", 24 * 3600))
+SOURCE_ID: Optional[int] = None if (sid := os.environ.get("SOURCE_ID")) is None else int(sid)
+
+FIELDS: list[str] = ["full_name", "email", "location", "phone_numbers", "skills", "urls"]
+LIST_FIELDS: set[str] = {"phone_numbers", "skills", "urls"}
+
+# word-anchored stems, a question matching several fields is left to GPT
+KEYWORDS: dict[str, tuple[str, ...]] = {
+    "full_name": (
+        r"\bфио\b", r"\bимя\b", r"\bфамили", r"\bзовут\b", r"\b(?:full|your|first|last)\s+name\b", r"\bsurname",
+        r"\bnombre\s+completo", r"\btu\s+nombre\b", r"\bapellido", r"\bllamas\b",
+    ),
+    "email": (
+        r"\bпочт(?:а|ы|у|ой|е)\b", r"\bэлектронн", r"\be-?mail", r"\bемейл", r"\bимейл", r"\bcorreo",
+    ),
+    "location": (
+        r"\bгород", r"\bстран[аыуе]\b", r"\bместоположени", r"\bпроживает", r"\bживете\b",
+        r"(?<!mail )\bадрес\w*\b(?!\s+(?:электронн|почт|e-?mail))", r"(?<!mail )\baddress\b", r"\blocation",
+        r"\bcity\b", r"\bcountry\b", r"\bciudad", r"\bpaís\b", r"\bdirecci[oó]n\b(?!\s+de\s+correo)", r"\bubicaci",
+    ),
+    "phone_numbers": (r"\bтелефон", r"\bphone", r"\btel[eé]fono", r"\bm[oó]vil\b", r"\bcelular"),
+    "skills": (r"\bнавык", r"\bskill", r"\bтехнолог", r"\bстек\b", r"\bstack\b", r"\bhabilidad", r"\btecnolog"),
+    "urls": (
+        r"\bссылк", r"\burls?\b", r"\blinks?\b", r"\blinkedin", r"\bgithub", r"\bпортфолио", r"\bportfolio",
+        r"\benlace", r"\bсайт", r"\bwebsite",
+    ),
+}
+KEYWORD_RES: dict[str, re.Pattern] = {field: re.compile("|".join(words)) for field, words in KEYWORDS.items()}
+
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+PHONE_RE = re.compile(r"\+?\d[\d\s().-]{5,}\d")
+URL_RE = re.compile(r"https?://\S+|\b(?:[\w-]+\.)+[a-z]{2,}/\S*", re.IGNORECASE)
+SKILLS_SEPARATOR_RE = re.compile(r"[,;\n•]")
+
+_mapping: Optional[tuple[int, list[Optional[str]]]] = None
+_mapping_lock = threading.Lock()
+# one mapping computation per config version, other versions and cached reads do not wait for it
+_version_locks: dict[int, threading.Lock] = {}
+
+
+def get_mapping(my_db: db.SQLAlchemy, version: int, params: list[str]) -> list[Optional[str]]:
+    global _mapping
+
+    mapping: Optional[list[Optional[str]]] = _get_cached_mapping(version, params)
+    if mapping is not None:
+        return mapping
+
+    with _get_version_lock(version):
+        mapping = _get_cached_mapping(version, params)
+        if mapping is not None:
+            return mapping
+
+        mapping = my_db.get_crm_mapping(version)
+        if mapping is None or len(mapping) != len(params):
+            mapping, answered = build_mapping(params)
+            if not answered:
+                # the model failed, the next candidate retries
+                return mapping
+            # stored even with fields left unmapped, finish_survey reads those from the answers
+            my_db.set_crm_mapping(version, mapping)
+
+        with _mapping_lock:
+            _mapping = version, mapping
+        return mapping
+
+
+def _get_cached_mapping(version: int, params: list[str]) -> Optional[list[Optional[str]]]:
+    with _mapping_lock:
+        if _mapping is not None and _mapping[0] == version and len(_mapping[1]) == len(params):
+            return _mapping[1]
+    return None
+
+
+def _get_version_lock(version: int) -> threading.Lock:
+    with _mapping_lock:
+        if version not in _version_locks:
+            for old_version in [v for v in _version_locks if v < version]:
+                del _version_locks[old_version]
+            _version_locks[version] = threading.Lock()
+        return _version_locks[version]
+
+
+def build_mapping(params: list[str]) -> tuple[list[Optional[str]], bool]:
+    mapping: list[Optional[str]] = [_match(param) for param in params]
+    # two questions claiming one field are as ambiguous as one question claiming two
+    mapping = [None if field is not None and mapping.count(field) > 1 else field for field in mapping]
+
+    unknown: list[int] = [index for index, field in enumerate(mapping) if field is None]
+    if not unknown:
+        return mapping, True
+
+    try:
+        fields: Optional[dict[int, Optional[str]]] = gpt.GPT.get_crm_mapping([params[i] for i in unknown], FIELDS)
+    except Exception:
+        logging.exception("Failed to map params to crm fields")
+        return mapping, False
+
+    if fields is None:
+        return mapping, False
+
+    for local_index, field in fields.items():
+        if 0 <= local_index < len(unknown) and field in FIELDS:
+            mapping[unknown[local_index]] = field
+
+    return mapping, True
+
+
+def get_unmapped_params(params: list[dict], mapping: list[Optional[str]]) -> list[dict]:
+    # answers of questions without a field are only needed while some field has no question
+    if set(FIELDS) <= set(mapping):
+        return []
+
+    return [
+        param for param in params
+        if param["value"] and (int(param["index"]) >= len(mapping) or mapping[int(param["index"])] is None)
+    ]
+
+
+def _match(param: str) -> Optional[str]:
+    name: str = param.lower().replace("ё", "е")
+    fields: list[str] = [field for field, pattern in KEYWORD_RES.items() if pattern.search(name)]
+    return fields[0] if len(fields) == 1 else None
+
+
+def build_payload(params: list[dict], mapping: list[Optional[str]]) -> tuple[dict, list[dict]]:
+    payload: dict = {}
+    unresolved: list[dict] = []
+
+    for param in params:
+        index: int = int(param["index"])
+        field: Optional[str] = mapping[index] if index < len(mapping) else None
+        if field is None or not param["value"]:
+            continue
+
+        values: list[str] = NORMALIZERS[field](str(param["value"]))
+        if not values:
+            unresolved.append(param)
+            continue
+
+        payload = merge(payload, {field: values if field in LIST_FIELDS else values[0]})
+
+    return payload, unresolved
+
+
+def merge(payload: dict, extra: dict) -> dict:
+    result: dict = dict(payload)
+
+    for field, value in extra.items():
+        if field not in FIELDS or not value:
+            continue
+
+        if field in LIST_FIELDS:
+            values: list[str] = result.get(field, [])
+            result[field] = values + [item for item in _as_list(value) if item not in values]
+        else:
+            result.setdefault(field, value)
+
+    return result
+
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+
+def _normalize_text(value: str) -> list[str]:
+    text: str = " ".join(value.split())
+    return [text] if text else []
+
+
+def _normalize_emails(value: str) -> list[str]:
+    return [email.lower() for email in EMAIL_RE.findall(value)]
+
+
+def _normalize_phones(value: str) -> list[str]:
+    phones: list[str] = []
+    for match in PHONE_RE.findall(value):
+        phone: str = ("+" if match.startswith("+") else "") + re.sub(r"\D", "", match)
+        if len(phone.lstrip("+")) >= 7:
+            phones.append(phone)
+    return phones
+
+
+def _normalize_skills(value: str) -> list[str]:
+    return [skill for part in SKILLS_SEPARATOR_RE.split(value) if (skill := " ".join(part.split()))]
+
+
+def _normalize_urls(value: str) -> list[str]:
+    return [url.rstrip(".,;)") for url in URL_RE.findall(value)]
+
+
+NORMALIZERS: dict[str, Callable[[str], list[str]]] = {
+    "full_name": _normalize_text,
+    "email": _normalize_emails,
+    "location": _normalize_text,
+    "phone_numbers": _normalize_phones,
+    "skills": _normalize_skills,
+    "urls": _normalize_urls,
+}
+
+
+class RetryLater(Exception):
+    def __init__(self, delay: float, reason: str):
+        super().__init__(f"{reason}, retry in {delay:.1f}s")
+        self.delay = delay
+
+
+class RateLimiter:
+    # token bucket shared by all processes, TIME keeps workers with skewed clocks consistent
+    SCRIPT = """
+        local now_parts = redis.call('TIME')
+        local now = now_parts[1] * 1000 + math.floor(now_parts[2] / 1000)
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+
+        local paused = redis.call('PTTL', KEYS[2])
+        if paused > 0 then
+            return paused
+        end
+
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or burst
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = math.ceil((1 - tokens) * 1000 / rate)
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+        return wait
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, redis_url: str = cache.CACHE_REDIS_URL):
+        self._bucket_key = f"{name}:bucket"
+        self._paused_key = f"{name}:paused"
+        self._rate = rate
+        self._burst = burst
+        self._redis = redis.Redis.from_url(redis_url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    def acquire(self, max_wait: float = CRM_MAX_WAIT):
+        waited: float = 0.0
+        while True:
+            try:
+                wait: float = self._script(
+                    keys=[self._bucket_key, self._paused_key], args=[self._rate, self._burst]
+                ) / 1000
+            except redis.RedisError:
+                logging.exception(f"Failed to take a token from {self._bucket_key}, sending without the limit")
+                return
+
+            if wait <= 0:
+                return
+            if waited + wait > max_wait:
+                raise RetryLater(wait, f"{self._bucket_key} is exhausted")
+
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        # only the key's ttl is compared, so no worker clock is involved
+        try:
+            self._redis.set(self._paused_key, 1, px=max(int(seconds * 1000), 1))
+        except redis.RedisError:
+            logging.exception(f"Failed to pause {self._bucket_key}")
+
+
+class PendingUpdates:
+    RESUME_FIELD: str = "__resume__"
+    # the flag is kept while anything newer is waiting, otherwise it is dropped
+    FINISH_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return 1
+        end
+        redis.call('DEL', KEYS[2])
+        return 0
+    """
+
+    def __init__(self, name: str, ttl: int = CRM_PENDING_TTL, redis_url: str = cache.CACHE_REDIS_URL):
+        self._name = name
+        self._ttl = ttl
+        self._redis = redis.Redis.from_url(redis_url)
+        self._finish_script = self._redis.register_script(self.FINISH_SCRIPT)
+
+    def add(self, tg_chat_id: str, data: dict, resume: Optional[str]) -> bool:
+        key: str = self._key(tg_chat_id)
+        fields: dict = {name: json.dumps(value, ensure_ascii=False) for name, value in data.items()}
+        if resume:
+            fields[self.RESUME_FIELD] = json.dumps(resume)
+
+        pipeline = self._redis.pipeline()
+        if fields:
+            pipeline.hset(key, mapping=fields)
+        pipeline.expire(key, self._ttl)
+        pipeline.set(f"{key}:scheduled", 1, nx=True, ex=self._ttl)
+
+        # a flush is already scheduled unless the flag was just set
+        return bool(pipeline.execute()[-1])
+
+    def take(self, tg_chat_id: str) -> Optional[tuple[dict, Optional[str]]]:
+        key: str = self._key(tg_chat_id)
+
+        # the scheduled flag stays until finish(): updates arriving during the request wait for it
+        # instead of starting a second flush that would not see the new candidate id
+        pipeline = self._redis.pipeline()
+        pipeline.hgetall(key)
+        pipeline.delete(key)
+        pipeline.expire(f"{key}:scheduled", self._ttl)
+        fields: dict[bytes, bytes] = pipeline.execute()[0]
+        if not fields:
+            return None
+
+        data: dict = {name.decode(): json.loads(value) for name, value in fields.items()}
+        return data, data.pop(self.RESUME_FIELD, None)
+
+    def restore(self, tg_chat_id: str, data: dict, resume: Optional[str]):
+        key: str = self._key(tg_chat_id)
+        fields: dict = {name: json.dumps(value, ensure_ascii=False) for name, value in data.items()}
+        if resume:
+            fields[self.RESUME_FIELD] = json.dumps(resume)
+
+        # values added while the request was in flight are newer and win
+        pipeline = self._redis.pipeline()
+        for name, value in fields.items():
+            pipeline.hsetnx(key, name, value)
+        pipeline.expire(key, self._ttl)
+        pipeline.execute()
+
+    def finish(self, tg_chat_id: str) -> bool:
+        key: str = self._key(tg_chat_id)
+        # true when updates arrived during the request and still need a flush
+        return bool(self._finish_script(keys=[key, f"{key}:scheduled"]))
+
+    def release(self, tg_chat_id: str):
+        self._redis.delete(f"{self._key(tg_chat_id)}:scheduled")
+
+    def _key(self, tg_chat_id: str) -> str:
+        return f"{self._name}:{tg_chat_id}"
+
+
+class Client:
+    def __init__(self, base_url: str = CRM_URL, api_key: str = CRM_API_KEY, limiter: Optional[RateLimiter] = None):
+        self._base_url = base_url
+        self._limiter = limiter
+        self._session = requests.Session()
+        self._session.headers.update({"Accept": "application/json", "X-API-KEY": api_key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CRM_MAX_CONNECTIONS)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def get_candidates_url(self, crm_candidate_id: Optional[int] = None) -> str:
+        url: str = f"{self._base_url}/recruitment/candidates"
+        return url if crm_candidate_id is None else f"{url}/{crm_candidate_id}"
+
+    def send(self, crm_candidate_id: Optional[int], data: dict, resume: Optional[str]) -> requests.Response:
+        method: str = "POST" if crm_candidate_id is None else "PUT"
+        url: str = self.get_candidates_url(crm_candidate_id)
+
+        payload: dict = {
+            f"{name}[]" if value and isinstance(value, list) else name: value for name, value in data.items()
+        }
+        if SOURCE_ID is not None:
+            payload["source_id"] = SOURCE_ID
+
+        if self._limiter is not None:
+            self._limiter.acquire()
+
+        with MinioClient().open(resume) if resume else nullcontext() as resume_file:
+            files: dict = {}
+            if resume_file is not None:
+                # the resume is read from minio while the request body is sent
+                size = int(resume_file.headers["Content-Length"])
+                files["resume"] = (resume, resume_file, size, "application/octet-stream")
+
+            body = multipart.MultipartBody(payload, files)
+            response = self._session.request(
+                method=method,
+                url=url,
+                data=body,
+                headers={"Content-Type": body.content_type},
+                timeout=CRM_TIMEOUT,
+            )
+
+        if response.status_code in {429, 503}:
+            delay: float = _get_retry_after(response)
+            if self._limiter is not None:
+                self._limiter.pause(delay)
+            raise RetryLater(delay, f"crm answered {response.status_code} to {method} {url}")
+
+        assert response.status_code in {200, 201}, (
+            f"failed crm integration: response code={response.status_code}, text={response.text}; request {method=}, {url=}, {payload=}"
+        )
+
+        return response
+
+
+def _get_retry_after(response: requests.Response, default: float = 60) -> float:
+    value: Optional[str] = response.headers.get("Retry-After")
+    if not value:
+        return default
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+_client: Optional[Client] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Client:
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Client(limiter=RateLimiter("survey:crm", CRM_RATE_LIMIT, CRM_RATE_BURST))
+
+    return _client
+
+
+def _reset_after_fork():
+    global _client, _client_lock, _mapping_lock, _version_locks
+
+    _client = None
+    _client_lock = threading.Lock()
+    _mapping_lock = threading.Lock()
+    _version_locks = {}
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+pending = PendingUpdates("survey:crm:pending")
@@ -1,26 +1,86 @@
+import enum
+import functools
 import os
-import subprocess
-import tempfile
-from typing import IO
+import string
+from html import escape
+from typing import Optional
 
-from survey import gpt
+from survey import cache, gpt, pdf, utils
 
-HTML_TO_PDF_FP = os.environ.get("HTML_TO_PDF_FP", "/bin/wkhtmltopdf")
 
+class Mode(enum.Enum):
+    HTML = "html"
+    STRUCTURED = "structured"
 
-def save(data: dict, result_fp: str):
-    with tempfile.NamedTemporaryFile(mode='w', encoding="utf-8-sig", suffix=".html") as file:     # type: IO[str]
-        html = _get_html(data)
 
-        file.write(html)
-        file.seek(0)
+CV_MODE: Mode = Mode(os.environ.get("CV_MODE", Mode.STRUCTURED.value))
+TEMPLATE_FP: str = "files/cv_template.html"
 
-        _html_to_pdf(file.name, dst_fp=result_fp)
 
+def render(data: dict, lang: str) -> bytes:
+    return pdf.render(_get_html(data, lang))
 
-def _get_html(data: dict) -> str:
-    return gpt.GPT.get_cv_html(data)
 
+def fingerprint(data: dict, lang: str) -> str:
+    sources: list[str] = [gpt.CV_PROMPT_FP] if CV_MODE == Mode.HTML else [gpt.CV_DATA_PROMPT_FP, TEMPLATE_FP]
+    return cache.fingerprint(
+        "cv", CV_MODE.value, data, lang, gpt.GPT_MODEL_NAME, *map(cache.file_fingerprint, sources)
+    )
 
-def _html_to_pdf(src_fp: str, dst_fp: str):
-    subprocess.run([HTML_TO_PDF_FP, src_fp, dst_fp])
+
+def _get_html(data: dict, lang: str) -> str:
+    if CV_MODE == Mode.HTML:
+        return gpt.GPT.get_cv_html(data)
+
+    cv: Optional[dict] = gpt.GPT.get_cv_data(data, lang)
+    assert cv is not None, "failed to get cv data"
+
+    return render_html(cv, lang)
+
+
+def render_html(cv: dict, lang: str) -> str:
+    summary: str = cv.get("summary") or ""
+
+    return _get_template(lang).substitute(
+        full_name=escape(cv.get("full_name") or ""),
+        headline=escape(cv.get("headline") or ""),
+        contacts="\n".join(
+            f"        <p><strong>{escape(contact['label'])}:</strong> {escape(contact['value'])}</p>"
+            for contact in cv.get("contacts") or []
+        ),
+        summary=_section(utils.get_text("cv_summary", lang), [f"<p>{escape(summary)}</p>"]) if summary else "",
+        sections="\n".join(
+            _section(section["title"], [_entry(entry) for entry in section.get("entries") or []])
+            for section in cv.get("sections") or []
+        ),
+    )
+
+
+@functools.lru_cache
+def _get_template(lang: str) -> string.Template:
+    with open(TEMPLATE_FP, "r", encoding="utf-8") as file:
+        return string.Template(string.Template(file.read()).safe_substitute(lang=escape(lang)))
+
+
+def _section(title: str, blocks: list[str]) -> str:
+    return "\n".join([
+        '    <div class="section">',
+        f"        <h2>{escape(title)}</h2>",
+        *(f"        {block}" for block in blocks),
+        "    </div>",
+    ])
+
+
+def _entry(entry: dict) -> str:
+    lines: list[str] = []
+    if entry.get("title"):
+        lines.append(f"<p><strong>{escape(entry['title'])}</strong></p>")
+
+    details: list[str] = [f"<em>{escape(entry[key])}</em>" for key in ("subtitle", "period") if entry.get(key)]
+    if details:
+        lines.append(f"<p>{' - '.join(details)}</p>")
+
+    if entry.get("bullets"):
+        lines.append("<ul>" + "".join(f"<li>{escape(bullet)}</li>" for bullet in entry["bullets"]) + "</ul>")
+
+    return "\n        ".join(lines)
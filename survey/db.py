@@ -1,12 +1,29 @@
 import csv
 import enum
 import logging
-from typing import Optional, Any
-from sqlalchemy import create_engine, Column, Integer, String, JSON, BigInteger
-from sqlalchemy.exc import SQLAlchemyError
+import os
+import threading
+import time
+from typing import Optional, Any, Callable, Iterator
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    create_engine, Column, Integer, String, JSON, BigInteger, Boolean, DateTime, UniqueConstraint, Index, cast, func,
+    literal, insert, inspect, select, text, update
+)
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
+from survey import tokenizer
+
+KNOWN_USERS_TTL: float = float(os.environ.get("KNOWN_USERS_TTL", 300))
+KNOWN_USERS_MAX_SIZE: int = int(os.environ.get("KNOWN_USERS_MAX_SIZE", 100_000))
+
+VACANCIES_VERSION_KEY: str = "vacancies_version"
+MIGRATION_KEY_PREFIX: str = "migration:"
+# the two-key form does not collide with the single-key per-chat locks of _insert_messages
+MIGRATION_LOCK_KEY: tuple[int, int] = (1, 0)
 
 Base = declarative_base()
 
@@ -20,6 +37,7 @@ class Config(Base):
 
     id = Column(Integer, primary_key=True)
     data = Column(JSON)
+    version = Column(Integer)
 
 
 class Users(Base):
@@ -31,6 +49,66 @@ class Users(Base):
     tg_data = Column(JSON)
     data = Column(JSON)
     crm_candidate_id = Column(BigInteger, nullable=True)
+    tokens = Column(BigInteger, nullable=True)
+    params_updated_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+
+class State(Base):
+    __tablename__ = 'state'
+
+    key = Column(String, primary_key=True)
+    value = Column(JSON)
+
+
+class TokenLedger(Base):
+    __tablename__ = 'token_ledger'
+
+    id = Column(BigInteger, primary_key=True)
+    tg_chat_id = Column(String, nullable=False, index=True)
+    amount = Column(BigInteger, nullable=False)
+    reason = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class Message(Base):
+    __tablename__ = 'messages'
+    __table_args__ = (
+        UniqueConstraint("tg_chat_id", "seq"),
+        Index("ix_messages_tg_chat_id_prefix_size", "tg_chat_id", "prefix_size"),
+        Index("ix_messages_tg_chat_id_prefix_tokens", "tg_chat_id", "prefix_tokens"),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    tg_chat_id = Column(String, nullable=False)
+    seq = Column(Integer, nullable=False)
+    data = Column(JSON, nullable=False)
+    size = Column(Integer)
+    prefix_size = Column(BigInteger)
+    tokens = Column(Integer)
+    prefix_tokens = Column(BigInteger)
+
+
+def message_size(message: dict) -> int:
+    return len(message.get("content") or "")
+
+
+def new_message(data: dict) -> Message:
+    return Message(data=data, size=message_size(data), tokens=tokenizer.message_tokens(data))
+
+
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # set while a replica processes the update, null once it is done
+    claimed_until = Column(DateTime(timezone=True), nullable=True)
+
+
+class Claim(enum.Enum):
+    CLAIMED = "claimed"
+    PROCESSING = "processing"
+    PROCESSED = "processed"
 
 
 class Vacancy(Base):
@@ -38,15 +116,35 @@ class Vacancy(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True)
+    active = Column(Boolean, default=True)
+    position = Column(Integer)
 
 
 class SQLAlchemy:
-    def __init__(self, db_url):
-        self.engine = create_engine(db_url)
+    def __init__(self, db_url, **engine_kwargs):
+        self.engine = create_engine(db_url, **engine_kwargs)
         self.Session = sessionmaker(bind=self.engine)
+        self.config_listeners: list[Callable[[int], None]] = []
+        self._known_users: dict[str, tuple[Optional[str], float]] = {}
+        # shared by all bot worker threads
+        self._known_users_lock = threading.Lock()
 
     def create_db(self, params: list[str], prompt: str):
+        # bot, webhook workers and celery workers start together: one of them migrates, the rest wait and
+        # find the migration flags set. The lock is a transaction one kept open on its own connection,
+        # a session lock would leak through pgbouncer transaction pooling; outside the pool,
+        # a pool of one connection would wait for itself
+        lock_engine = create_engine(self.engine.url, poolclass=NullPool)
+        try:
+            with lock_engine.begin() as lock_connection:
+                lock_connection.execute(select(func.pg_advisory_xact_lock(*MIGRATION_LOCK_KEY)))
+                self._create_db(params, prompt)
+        finally:
+            lock_engine.dispose()
+
+    def _create_db(self, params: list[str], prompt: str):
         Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
 
         with self.Session() as session:
             if not session.query(Config).first():
@@ -54,6 +152,226 @@ class SQLAlchemy:
                 session.add(config)
                 session.commit()
 
+        for migration in (
+                self.migrate_messages,
+                self._backfill_message_sizes,
+                self._backfill_message_tokens,
+                self._migrate_tokens,
+                self._backfill_params_updated_at,
+                self._backfill_vacancy_active,
+        ):
+            self._run_once(migration)
+
+    def _run_once(self, migration: Callable[[], None]):
+        # full-table scans: once per database, not on every process start, checked under the migration lock
+        key: str = f"{MIGRATION_KEY_PREFIX}{migration.__name__.lstrip('_')}"
+        if self.get_state(key):
+            return
+
+        migration()
+        self.set_state(key, True)
+
+    def _add_missing_columns(self):
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing: set[str] = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type: str = column.type.compile(dialect=self.engine.dialect)
+                    connection.execute(
+                        text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column.name} {column_type}")
+                    )
+                    logging.info(f"Added column {table.name}.{column.name}")
+
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+    def _backfill_message_sizes(self):
+        with self.Session() as session:
+            session.execute(text("""
+                UPDATE messages m SET size = s.size, prefix_size = s.prefix_size
+                FROM (
+                    SELECT
+                        id,
+                        length(coalesce(data->>'content', '')) AS size,
+                        coalesce(sum(length(coalesce(data->>'content', ''))) OVER (
+                            PARTITION BY tg_chat_id ORDER BY seq ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                        ), 0) AS prefix_size
+                    FROM messages
+                    WHERE tg_chat_id IN (SELECT tg_chat_id FROM messages WHERE size IS NULL)
+                ) s
+                WHERE m.id = s.id
+            """))
+            session.commit()
+
+    def _backfill_message_tokens(self, batch_size: int = 1_000):
+        with self.Session() as session:
+            chat_ids: list[str] = [
+                row.tg_chat_id
+                for row in session.query(Message.tg_chat_id).filter(Message.tokens.is_(None)).distinct()
+            ]
+
+            for tg_chat_id in chat_ids:
+                prefix_tokens: int = 0
+                messages = session.query(Message).filter_by(tg_chat_id=tg_chat_id).order_by(Message.seq)
+                for message in messages.yield_per(batch_size):
+                    if message.tokens is None:
+                        message.tokens = tokenizer.message_tokens(message.data)
+                    message.prefix_tokens = prefix_tokens
+                    prefix_tokens += message.tokens
+                session.commit()
+
+            if chat_ids:
+                logging.info(f"Counted message tokens for {len(chat_ids)} chats")
+
+    def _migrate_tokens(self):
+        with self.Session() as session:
+            session.execute(text(
+                "UPDATE users SET tokens = (data->>'tokens')::bigint "
+                "WHERE tokens IS NULL AND data->>'tokens' IS NOT NULL"
+            ))
+            session.commit()
+
+    def _backfill_params_updated_at(self):
+        with self.Session() as session:
+            session.query(Users).filter(
+                Users.params_updated_at.is_(None), cast(Users.data, JSONB).has_key("params")
+            ).update({"params_updated_at": func.now()}, synchronize_session=False)
+            session.commit()
+
+    def _backfill_vacancy_active(self):
+        with self.Session() as session:
+            session.query(Vacancy).filter(Vacancy.active.is_(None)).update(
+                {"active": True}, synchronize_session=False
+            )
+            session.commit()
+
+    def migrate_messages(self):
+        with self.Session() as session:
+            users = session.query(Users).filter(cast(Users.data, JSONB).has_key("messages")).all()
+            for user in users:
+                data: dict = dict(user.data)
+                self._insert_messages(session, user.tg_chat_id, list(map(new_message, data.pop("messages") or [])))
+                user.data = data
+                session.commit()
+
+            if users:
+                logging.info(f"Moved message history of {len(users)} users to the {Message.__tablename__} table")
+
+    def get_messages_window(self, tg_chat_id: str, budget: int, token_budget: int) -> list[Message]:
+        def total(column):
+            return select(column).where(
+                Message.tg_chat_id == tg_chat_id
+            ).order_by(Message.seq.desc()).limit(1).scalar_subquery()
+
+        with self.Session() as session:
+            return session.query(Message).filter(
+                Message.tg_chat_id == tg_chat_id,
+                Message.prefix_size > total(Message.prefix_size + Message.size) - budget,
+                Message.prefix_tokens > total(Message.prefix_tokens + Message.tokens) - token_budget,
+            ).order_by(Message.seq).all()
+
+    def add_messages(self, tg_chat_id: str, messages: list[Message]):
+        if not messages:
+            return
+
+        with self.Session() as session:
+            self._insert_messages(session, tg_chat_id, messages)
+            session.commit()
+
+    @staticmethod
+    def _insert_messages(session, tg_chat_id: str, messages: list[Message]):
+        if not messages:
+            return
+
+        # concurrent writers of one chat (webhook replicas, workers) would read the same last seq
+        session.execute(select(func.pg_advisory_xact_lock(func.hashtext(tg_chat_id))))
+        last = session.query(
+            Message.seq, Message.prefix_size + Message.size, Message.prefix_tokens + Message.tokens
+        ).filter(Message.tg_chat_id == tg_chat_id).order_by(Message.seq.desc()).first()
+        seq, prefix_size, prefix_tokens = last or (0, 0, 0)
+
+        rows: list[dict] = []
+        for message in messages:
+            seq += 1
+            rows.append({
+                "tg_chat_id": tg_chat_id,
+                "seq": seq,
+                "data": message.data,
+                "size": message.size,
+                "prefix_size": prefix_size,
+                "tokens": message.tokens,
+                "prefix_tokens": prefix_tokens,
+            })
+            prefix_size += message.size
+            prefix_tokens += message.tokens
+
+        session.execute(insert(Message), rows)
+
+    def claim_update(self, update_id: int, lease: timedelta) -> Claim:
+        statement = pg_insert(ProcessedUpdate).values(update_id=update_id, claimed_until=func.now() + lease)
+        with self.Session() as session:
+            # a claim whose lease ran out belongs to a crashed replica and is taken over
+            claimed = session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[ProcessedUpdate.update_id],
+                    set_={"claimed_until": statement.excluded.claimed_until},
+                    where=ProcessedUpdate.claimed_until < func.now(),
+                ).returning(ProcessedUpdate.update_id)
+            ).first()
+            processing: bool = claimed is None and session.query(ProcessedUpdate.claimed_until).filter_by(
+                update_id=update_id
+            ).scalar() is not None
+            session.commit()
+
+        if claimed is not None:
+            return Claim.CLAIMED
+        return Claim.PROCESSING if processing else Claim.PROCESSED
+
+    def complete_update(self, update_id: int):
+        with self.Session() as session:
+            session.query(ProcessedUpdate).filter_by(update_id=update_id).update(
+                {"claimed_until": None}, synchronize_session=False
+            )
+            session.commit()
+
+    def release_update(self, update_id: int):
+        with self.Session() as session:
+            session.query(ProcessedUpdate).filter_by(update_id=update_id).delete(synchronize_session=False)
+            session.commit()
+
+    def prune_processed_updates(self, older_than: timedelta) -> int:
+        with self.Session() as session:
+            deleted: int = session.query(ProcessedUpdate).filter(
+                ProcessedUpdate.created_at < func.now() - older_than
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+
+    def get_config(self) -> tuple[int, tuple[list[str], str]]:
+        with self.Session() as session:
+            config = session.query(Config).first()
+            data = config.data
+            return config.version or 0, (data["params"], data["prompt"])
+
+    def get_crm_mapping(self, version: int) -> Optional[list[Optional[str]]]:
+        with self.Session() as session:
+            data: Optional[dict] = session.query(Config.data).filter(
+                func.coalesce(Config.version, 0) == version
+            ).scalar()
+            return None if data is None else data.get("crm_mapping")
+
+    def set_crm_mapping(self, version: int, mapping: list[Optional[str]]):
+        merged = cast(Config.data, JSONB).op("||")(literal({"crm_mapping": mapping}, JSONB))
+
+        with self.Session() as session:
+            session.query(Config).filter(func.coalesce(Config.version, 0) == version).update(
+                {"data": cast(merged, JSON)}, synchronize_session=False
+            )
+            session.commit()
+
     def get_params_and_prompt(self) -> tuple[list[str], str]:
         with self.Session() as session:
             config = session.query(Config).first()
@@ -70,33 +388,151 @@ class SQLAlchemy:
             user = session.query(Users).filter_by(tg_chat_id=tg_chat_id).first()
             return user.tg_data if user else None
 
-    def set_chat_data(self, tg_chat_id: str, data: dict):
+    def set_chat_data(self, tg_chat_id: str, data: dict, params_changed: bool = False):
         with self.Session() as session:
             user = session.query(Users).filter_by(tg_chat_id=tg_chat_id).first()
             if user:
                 user.data = data
+                if params_changed:
+                    user.params_updated_at = func.now()
             else:
                 user = Users(tg_chat_id=tg_chat_id, data=data, ensure_ascii=False)
                 session.add(user)
             session.commit()
 
-    def create_if_not_exist(self, tg_chat_id: str, tg_username: str):
+    def get_user_snapshot(self, tg_chat_id: str) -> Optional[dict]:
+        with self.Session() as session:
+            row = session.query(
+                Users.data, Users.tg_data, Users.lang, Users.tokens
+            ).filter_by(tg_chat_id=tg_chat_id).first()
+            if row is None:
+                return None
+            return {"data": row.data or {}, "tg_data": row.tg_data or {}, "lang": row.lang, "tokens": row.tokens}
+
+    def update_chat_data(self, tg_chat_id: str, changes: dict):
+        merged = func.coalesce(cast(Users.data, JSONB), cast("{}", JSONB)).op("||")(literal(changes, JSONB))
+        values: dict = {"data": cast(merged, JSON)}
+        if "params" in changes:
+            values["params_updated_at"] = func.now()
+
+        with self.Session() as session:
+            session.query(Users).filter_by(tg_chat_id=tg_chat_id).update(values, synchronize_session=False)
+            session.commit()
+
+    def get_tokens(self, tg_chat_id: str) -> Optional[int]:
+        with self.Session() as session:
+            return session.query(Users.tokens).filter_by(tg_chat_id=tg_chat_id).scalar()
+
+    def change_tokens(self, tg_chat_id: str, amount: int, start_tokens: int, reason: str) -> Optional[int]:
+        with self.Session() as session:
+            balance: Optional[int] = session.execute(
+                update(Users).where(Users.tg_chat_id == tg_chat_id).values(
+                    tokens=func.coalesce(Users.tokens, start_tokens) + amount
+                ).returning(Users.tokens)
+            ).scalar()
+            if balance is not None:
+                session.add(TokenLedger(tg_chat_id=tg_chat_id, amount=amount, reason=reason))
+            session.commit()
+            return balance
+
+    def reserve_tokens(self, tg_chat_id: str, amount: int, start_tokens: int) -> Optional[int]:
+        balance = func.coalesce(Users.tokens, start_tokens)
+        with self.Session() as session:
+            left: Optional[int] = session.execute(
+                update(Users).where(Users.tg_chat_id == tg_chat_id, balance > 0).values(
+                    tokens=balance - amount
+                ).returning(Users.tokens)
+            ).scalar()
+            session.commit()
+            return left
+
+    def settle_tokens(self, tg_chat_id: str, reserved: int, spent: int, reason: str) -> Optional[int]:
+        with self.Session() as session:
+            balance: Optional[int] = session.execute(
+                update(Users).where(Users.tg_chat_id == tg_chat_id).values(
+                    tokens=Users.tokens + reserved - spent
+                ).returning(Users.tokens)
+            ).scalar()
+            if spent:
+                session.add(TokenLedger(tg_chat_id=tg_chat_id, amount=-spent, reason=reason))
+            session.commit()
+            return balance
+
+    def get_token_spend(self, since: Optional[datetime] = None) -> tuple[int, int]:
+        with self.Session() as session:
+            query = session.query(
+                func.coalesce(-func.sum(TokenLedger.amount), 0), func.count(func.distinct(TokenLedger.tg_chat_id))
+            ).filter(TokenLedger.amount < 0)
+            if since is not None:
+                query = query.filter(TokenLedger.created_at >= since)
+            spent, users = query.one()
+            return int(spent), users
+
+    def create_if_not_exist(self, tg_chat_id: str, tg_username: str, force: bool = False):
+        with self._known_users_lock:
+            known: Optional[tuple[Optional[str], float]] = self._known_users.get(tg_chat_id)
+        if not force and known is not None and known[0] == tg_username and time.monotonic() < known[1]:
+            return
+
         tg_data = {TgParam.username.value: tg_username}
+        statement = pg_insert(Users).values(tg_chat_id=tg_chat_id, tg_data=tg_data, data={})
         with self.Session() as session:
-            user = session.query(Users).filter_by(tg_chat_id=tg_chat_id).first()
-            if user:
-                user.tg_data = tg_data
-            else:
-                user = Users(tg_chat_id=tg_chat_id, tg_data=tg_data, data={})
-                session.add(user)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[Users.tg_chat_id],
+                set_={"tg_data": statement.excluded.tg_data},
+                where=cast(Users.tg_data, JSONB).is_distinct_from(cast(statement.excluded.tg_data, JSONB)),
+            ))
             session.commit()
 
+        with self._known_users_lock:
+            if len(self._known_users) >= KNOWN_USERS_MAX_SIZE and tg_chat_id not in self._known_users:
+                self._known_users.pop(next(iter(self._known_users)), None)
+            self._known_users[tg_chat_id] = (tg_username, time.monotonic() + KNOWN_USERS_TTL)
+
     def clear(self):
+        with self._known_users_lock:
+            self._known_users.clear()
+
         with self.Session() as session:
+            session.query(Message).delete()
             session.query(Users).delete()
             session.commit()
 
-    def write_file(self, temp_file, params: list[str], tg_params: list[str]):
+    def now(self) -> datetime:
+        with self.Session() as session:
+            return session.query(func.now()).scalar()
+
+    def get_state(self, key: str) -> Any:
+        with self.Session() as session:
+            return session.query(State.value).filter_by(key=key).scalar()
+
+    def set_state(self, key: str, value: Any):
+        with self.Session() as session:
+            statement = pg_insert(State).values(key=key, value=value)
+            session.execute(
+                statement.on_conflict_do_update(index_elements=[State.key], set_={"value": statement.excluded.value})
+            )
+            session.commit()
+
+    @staticmethod
+    def _filter_params_updated(query, since: Optional[datetime], until: Optional[datetime]):
+        if since is not None:
+            query = query.filter(Users.params_updated_at > since)
+        if until is not None:
+            query = query.filter(Users.params_updated_at <= until)
+        return query
+
+    def count_users(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> int:
+        with self.Session() as session:
+            return self._filter_params_updated(session.query(func.count(Users.id)), since, until).scalar()
+
+    def iter_export_rows(
+            self,
+            tg_params: list[str],
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            batch_size: int = 1_000,
+    ) -> Iterator[list]:
         def formatted_username_or_same(key: str, value: str) -> Any:
             if key != TgParam.username.value:
                 return value
@@ -104,21 +540,19 @@ class SQLAlchemy:
             return value and f"@{value}"
 
         with self.Session() as session:
-            rows = session.query(Users.tg_data, Users.data).all()
-            to_write = [[*tg_params, *params]]
-            for row in rows:
-                tg_data, data = (row[i] if row[i] else {} for i in range(2))
-                params = data.get("params", {})
-                max_ind = max([int(k) for k in params.keys()] or [0])
-                to_append = [
+            query = self._filter_params_updated(session.query(Users.tg_data, Users.data["params"]), since, until)
+            for row in query.yield_per(batch_size):
+                tg_data, user_params = (row[i] if row[i] else {} for i in range(2))
+                max_ind = max([int(k) for k in user_params.keys()] or [0])
+                yield [
                     *(formatted_username_or_same(p, tg_data.get(p)) for p in tg_params),
-                    *(params.get(str(i), None) for i in range(max_ind + 1))
+                    *(user_params.get(str(i), None) for i in range(max_ind + 1))
                 ]
-                to_write.append(to_append)
-            if not to_write:
-                to_write = [["empty"]]
-            csv_writer = csv.writer(temp_file)
-            csv_writer.writerows(to_write)
+
+    def write_file(self, temp_file, params: list[str], tg_params: list[str], **filters):
+        csv_writer = csv.writer(temp_file)
+        csv_writer.writerow([*tg_params, *params])
+        csv_writer.writerows(self.iter_export_rows(tg_params, **filters))
 
     def set_prompt(self, prompt: str):
         params, _ = self.get_params_and_prompt()
@@ -130,31 +564,60 @@ class SQLAlchemy:
 
     def _set_config(self, params, prompt):
         with self.Session() as session:
+            version: int = (session.query(func.max(Config.version)).scalar() or 0) + 1
             session.query(Config).delete()
-            config = Config(data={"params": params, "prompt": prompt})
+            config = Config(data={"params": params, "prompt": prompt}, version=version)
             session.add(config)
             session.commit()
 
-    def set_new_vacancies(self, values: list[str]):
-        with self.Session() as session:
-            try:
-                session.query(Vacancy).delete()
+        for listener in self.config_listeners:
+            listener(version)
 
-                new_vacancies = [Vacancy(name=name) for name in values]
-                session.add_all(new_vacancies)
+    def sync_vacancies(self, names: list[str]) -> Optional[int]:
+        positions: dict[str, int] = {}
+        for name in names:
+            positions.setdefault(name, len(positions))
 
-                session.commit()
-            except SQLAlchemyError as e:
-                session.rollback()
-                logging.error(f"An error occurred while setting new vacancies: {e}")
+        with self.Session() as session:
+            changed: bool = False
+            for vacancy in session.query(Vacancy).with_for_update().all():
+                active: bool = vacancy.name in positions
+                position: Optional[int] = positions.pop(vacancy.name, vacancy.position)
+                if vacancy.active != active or vacancy.position != position:
+                    vacancy.active, vacancy.position = active, position
+                    changed = True
+
+            # rows are never deleted: ids stay valid for buttons already sent
+            session.add_all([
+                Vacancy(name=name, active=True, position=position) for name, position in positions.items()
+            ])
+            if not changed and not positions:
+                return None
+
+            version: int = (session.query(State.value).filter_by(key=VACANCIES_VERSION_KEY).scalar() or 0) + 1
+            statement = pg_insert(State).values(key=VACANCIES_VERSION_KEY, value=version)
+            session.execute(
+                statement.on_conflict_do_update(index_elements=[State.key], set_={"value": statement.excluded.value})
+            )
+            session.commit()
+            return version
+
+    def get_vacancies(self) -> list[Vacancy]:
+        with self.Session() as session:
+            return list(
+                session.query(Vacancy).filter(Vacancy.active.is_(True)).order_by(
+                    Vacancy.position.nulls_last(), Vacancy.id
+                ).all()
+            )
 
-    def get_vacancies(self):
+    def get_vacancies_versioned(self) -> tuple[int, list[Vacancy]]:
         with self.Session() as session:
-            return list(session.query(Vacancy).all())
+            version: int = session.query(State.value).filter_by(key=VACANCIES_VERSION_KEY).scalar() or 0
+        return version, self.get_vacancies()
 
     def get_vacancy_name_by_id(self, value: int):
         with self.Session() as session:
-            return session.query(Vacancy).filter_by(id=value).first()
+            return session.query(Vacancy).filter_by(id=value, active=True).first()
 
     def get_lang(self, tg_chat_id: str) -> Optional[dict]:
         with self.Session() as session:
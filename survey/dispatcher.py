@@ -0,0 +1,45 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class KeyedDispatcher(Generic[T]):
+    def __init__(self, handle: Callable[[T], None], workers: int):
+        self._handle = handle
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatcher")
+        # items of a key with a drain running or scheduled, one drain per key keeps them in order
+        self._queues: dict[Hashable, deque[T]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._queues)
+
+    def submit(self, key: Hashable, item: T):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(item)
+                return
+
+            self._queues[key] = deque([item])
+
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: Hashable):
+        while True:
+            with self._lock:
+                queue: deque[T] = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                item: T = queue.popleft()
+
+            try:
+                self._handle(item)
+            except Exception:
+                logging.exception(f"Failed to process item for {key=}")
@@ -0,0 +1,105 @@
+import enum
+import gzip
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterator, Optional
+
+import pyarrow
+import pyarrow.parquet
+
+from survey import db
+
+BATCH_SIZE: int = int(os.environ.get("EXPORT_BATCH_SIZE", 1_000))
+WATERMARK_OVERLAP: float = float(os.environ.get("EXPORT_WATERMARK_OVERLAP", 300))
+
+
+class Format(enum.Enum):
+    CSV = "csv"
+    CSV_GZ = "csv.gz"
+    PARQUET = "parquet"
+
+
+@dataclass
+class Export:
+    path: str
+    watermark_key: Optional[str] = None
+    watermark: Optional[datetime] = None
+
+    def commit(self, my_db: db.SQLAlchemy):
+        if self.watermark_key is not None:
+            my_db.set_state(self.watermark_key, self.watermark.isoformat())
+
+
+def parse_args(words: list[str]) -> tuple[Format, bool]:
+    if "parquet" in words:
+        fmt = Format.PARQUET
+    elif "gz" in words:
+        fmt = Format.CSV_GZ
+    else:
+        fmt = Format.CSV
+
+    return fmt, "new" in words
+
+
+def get_watermark_key(fmt: Format) -> str:
+    return f"export_watermark:{fmt.value}"
+
+
+def get_watermark(my_db: db.SQLAlchemy, fmt: Format) -> Optional[datetime]:
+    value: Optional[str] = my_db.get_state(get_watermark_key(fmt))
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def get_since(my_db: db.SQLAlchemy, fmt: Format) -> Optional[datetime]:
+    watermark: Optional[datetime] = get_watermark(my_db, fmt)
+    # params_updated_at is the start of the writing transaction, one that committed after the previous
+    # export read its rows is older than the watermark: the overlap exports it, at the cost of repeating some users
+    return None if watermark is None else watermark - timedelta(seconds=WATERMARK_OVERLAP)
+
+
+def count(my_db: db.SQLAlchemy, fmt: Format, incremental: bool) -> int:
+    return my_db.count_users(since=get_since(my_db, fmt) if incremental else None)
+
+
+def export_users(
+        my_db: db.SQLAlchemy, params: list[str], tg_params: list[str], fmt: Format, incremental: bool
+) -> Export:
+    filters: dict = {}
+    result = Export(path="")
+    if incremental:
+        result.watermark_key, result.watermark = get_watermark_key(fmt), my_db.now()
+        filters = {"since": get_since(my_db, fmt), "until": result.watermark}
+
+    fd, result.path = tempfile.mkstemp(dir="./", suffix=f".{fmt.value}")
+    os.close(fd)
+
+    try:
+        if fmt == Format.PARQUET:
+            rows = my_db.iter_export_rows(tg_params, batch_size=BATCH_SIZE, **filters)
+            _write_parquet(result.path, [*tg_params, *params], rows)
+        else:
+            with (gzip.open if fmt == Format.CSV_GZ else open)(
+                    result.path, "wt", encoding="utf-8-sig", newline=""
+            ) as file:
+                my_db.write_file(file, params, tg_params, batch_size=BATCH_SIZE, **filters)
+    except Exception:
+        os.remove(result.path)
+        raise
+
+    return result
+
+
+def _write_parquet(path: str, header: list[str], rows: Iterator[list]):
+    names: list[str] = [name if header.index(name) == i else f"{name}_{i}" for i, name in enumerate(header)]
+    schema = pyarrow.schema([(name, pyarrow.string()) for name in names])
+
+    with pyarrow.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+        while batch := list(islice(rows, BATCH_SIZE)):
+            columns = [
+                [None if i >= len(row) or row[i] is None else str(row[i]) for row in batch]
+                for i in range(len(names))
+            ]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
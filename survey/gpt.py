@@ -2,13 +2,78 @@ import enum
 import json
 import logging
 import os
-from typing import Optional
+import threading
+from typing import Callable, Iterator, Optional
 
+import httpx
 from openai import OpenAI
-from openai.types.chat import ChatCompletionMessage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+
+from survey import metrics, tokenizer
 
 GPT_MODEL_NAME = os.environ.get("GPT_MODEL_NAME", "gpt-4o")
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+GPT_MAX_CONCURRENCY: int = int(os.environ.get("GPT_MAX_CONCURRENCY", 20))
+GPT_TIMEOUT: float = float(os.environ.get("GPT_TIMEOUT", 60))
+GPT_CV_TIMEOUT: float = float(os.environ.get("GPT_CV_TIMEOUT", 180))
+
+CRM_PROMPT_FP: str = "files/categorize_params_prompt.txt"
+CRM_MAPPING_PROMPT_FP: str = "files/crm_mapping_prompt.txt"
+CV_PROMPT_FP: str = "files/prompt_cv.txt"
+CV_DATA_PROMPT_FP: str = "files/prompt_cv_data.txt"
+
+_client: Optional[OpenAI] = None
+_client_lock = threading.Lock()
+_in_flight = threading.BoundedSemaphore(GPT_MAX_CONCURRENCY)
+
+
+def get_client() -> OpenAI:
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    timeout=GPT_TIMEOUT,
+                    http_client=httpx.Client(
+                        limits=httpx.Limits(
+                            max_connections=GPT_MAX_CONCURRENCY,
+                            max_keepalive_connections=GPT_MAX_CONCURRENCY,
+                        ),
+                        timeout=GPT_TIMEOUT,
+                    ),
+                )
+
+    return _client
+
+
+def _reset_after_fork():
+    global _client, _client_lock, _in_flight
+
+    _client = None
+    _client_lock = threading.Lock()
+    _in_flight = threading.BoundedSemaphore(GPT_MAX_CONCURRENCY)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def create_completion(timeout: float = GPT_TIMEOUT, **kwargs) -> ChatCompletion:
+    with _in_flight:
+        return get_client().chat.completions.create(model=GPT_MODEL_NAME, timeout=timeout, **kwargs)
+
+
+def stream_completion(timeout: float = GPT_TIMEOUT, **kwargs) -> Iterator[ChatCompletionChunk]:
+    with _in_flight:
+        with get_client().chat.completions.create(
+            model=GPT_MODEL_NAME,
+            timeout=timeout,
+            stream=True,
+            extra_body={"stream_options": {"include_usage": True}},
+            **kwargs,
+        ) as stream:
+            yield from stream
 
 
 class GPT:
@@ -18,7 +83,11 @@ class GPT:
         ASSISTANT = "assistant"
 
     @staticmethod
-    def get_question(messages: list[dict], indexes: Optional[list[int]]) -> tuple[Optional[str], Optional[dict], int]:
+    def get_question(
+            messages: list[dict],
+            indexes: Optional[list[int]],
+            on_text: Optional[Callable[[str], None]] = None,
+    ) -> tuple[Optional[str], Optional[dict], int]:
         tools: dict = {} if indexes is None else {
             "tools": [
                 {
@@ -46,14 +115,17 @@ class GPT:
             ]
         }
 
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
         try:
-            completion = client.chat.completions.create(
-                messages=messages,
-                model=GPT_MODEL_NAME,
-                **tools,
-            )
+            with metrics.GPT_SECONDS.labels(GPT_MODEL_NAME).time():
+                if on_text is not None:
+                    question, callbacks, tokens = GPT._stream_question(messages, tools, on_text)
+                    metrics.GPT_TOKENS.labels(GPT_MODEL_NAME).inc(tokens)
+                    return question, callbacks, tokens
+
+                completion = create_completion(
+                    messages=messages,
+                    **tools,
+                )
         except Exception:
             logging.error(
                 "Failed get completion:\nmessages:\n{}\ntools:\n{}".format(
@@ -64,6 +136,7 @@ class GPT:
 
         message: ChatCompletionMessage = completion.choices[0].message
         tokens: int = completion.usage.total_tokens
+        metrics.GPT_TOKENS.labels(GPT_MODEL_NAME).inc(tokens)
 
         if message.tool_calls:
             call_list = []
@@ -73,18 +146,63 @@ class GPT:
 
         return completion.choices[0].message.content, None, tokens
 
+    @staticmethod
+    def _stream_question(
+            messages: list[dict], tools: dict, on_text: Callable[[str], None]
+    ) -> tuple[Optional[str], Optional[dict], int]:
+        text: str = ""
+        tool_calls: dict[int, dict] = {}
+        tokens: Optional[int] = None
+
+        for chunk in stream_completion(messages=messages, **tools):
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                tokens = usage["total_tokens"] if isinstance(usage, dict) else usage.total_tokens
+
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+
+            if delta.content:
+                text += delta.content
+                on_text(text)
+
+            for call_delta in delta.tool_calls or []:
+                call: dict = tool_calls.setdefault(
+                    call_delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+                )
+                if call_delta.id:
+                    call["id"] = call_delta.id
+                if call_delta.function:
+                    call["function"]["name"] += call_delta.function.name or ""
+                    call["function"]["arguments"] += call_delta.function.arguments or ""
+
+        calls: list[dict] = [tool_calls[index] for index in sorted(tool_calls)]
+
+        if tokens is None:
+            tokens = sum(map(tokenizer.message_tokens, messages)) + tokenizer.message_tokens(
+                {"content": text, "tool_calls": calls}
+            )
+
+        if calls:
+            message: dict = {"role": GPT.Role.ASSISTANT.value, "content": text or None, "tool_calls": calls}
+            call_list = [{"args": json.loads(call["function"]["arguments"]), "call_id": call["id"]} for call in calls]
+            return None, {"calls": call_list, "message": message}, tokens
+
+        return text, None, tokens
+
     @staticmethod
     def get_crm_data(params: list) -> Optional[dict]:
         messages: list[dict] = [{
             "role": GPT.Role.SYSTEM.value,
-            "content": open("files/categorize_params_prompt.txt", "r", encoding="utf-8").read().replace(
+            "content": open(CRM_PROMPT_FP, "r", encoding="utf-8").read().replace(
                 "<params>", json.dumps(params, ensure_ascii=False, indent=2)
             )
         }]
 
-        completion = OpenAI(api_key=OPENAI_API_KEY).chat.completions.create(
+        completion = create_completion(
             messages=messages,
-            model=GPT_MODEL_NAME,
             tool_choice="required",
             tools=[{
                 "type": "function",
@@ -140,12 +258,59 @@ class GPT:
             for call in message.tool_calls:
                 return json.loads(call.function.arguments)
 
+    @staticmethod
+    def get_crm_mapping(params: list[str], fields: list[str]) -> Optional[dict[int, Optional[str]]]:
+        messages: list[dict] = [{
+            "role": GPT.Role.SYSTEM.value,
+            "content": open(CRM_MAPPING_PROMPT_FP, "r", encoding="utf-8").read().replace(
+                "<params>", json.dumps(dict(enumerate(params)), ensure_ascii=False, indent=2)
+            )
+        }]
+
+        completion = create_completion(
+            messages=messages,
+            tool_choice="required",
+            tools=[{
+                "type": "function",
+                "function": {
+                    "name": "set_crm_mapping",
+                    "description": "Set the CRM field of every parameter",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "mapping": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "index": {"type": "integer", "enum": list(range(len(params)))},
+                                        "field": {"type": "string", "enum": [*fields, "none"]},
+                                    },
+                                    "required": ["index", "field"],
+                                },
+                            },
+                        },
+                        "required": ["mapping"],
+                    }
+                }
+            }],
+        )
+
+        message: ChatCompletionMessage = completion.choices[0].message
+
+        if completion.choices[0].message.tool_calls:
+            for call in message.tool_calls:
+                return {
+                    item["index"]: None if item["field"] == "none" else item["field"]
+                    for item in json.loads(call.function.arguments)["mapping"]
+                }
+
     @staticmethod
     def get_cv_html(data: dict) -> Optional[str]:
         messages: list[dict] = [
             {
                 "role": GPT.Role.SYSTEM.value,
-                "content": open("files/prompt_cv.txt", "r", encoding="utf-8").read()
+                "content": open(CV_PROMPT_FP, "r", encoding="utf-8").read()
             },
             {
                 "role": GPT.Role.SYSTEM.value,
@@ -153,9 +318,9 @@ class GPT:
             }
         ]
 
-        completion = OpenAI(api_key=OPENAI_API_KEY).chat.completions.create(
+        completion = create_completion(
+            timeout=GPT_CV_TIMEOUT,
             messages=messages,
-            model=GPT_MODEL_NAME,
             tool_choice="required",
             tools=[{
                 "type": "function",
@@ -181,3 +346,76 @@ class GPT:
         if completion.choices[0].message.tool_calls:
             for call in message.tool_calls:
                 return json.loads(call.function.arguments)["cv_html"]
+
+    @staticmethod
+    def get_cv_data(data: dict, lang: str) -> Optional[dict]:
+        messages: list[dict] = [
+            {
+                "role": GPT.Role.SYSTEM.value,
+                "content": open(CV_DATA_PROMPT_FP, "r", encoding="utf-8").read().replace("<lang>", lang)
+            },
+            {
+                "role": GPT.Role.SYSTEM.value,
+                "content": json.dumps(data, ensure_ascii=False)
+            }
+        ]
+
+        completion = create_completion(
+            messages=messages,
+            tool_choice="required",
+            tools=[{
+                "type": "function",
+                "function": {
+                    "name": "save_cv",
+                    "description": "Save the structured CV",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "full_name": {"type": "string"},
+                            "headline": {"type": "string", "description": "Desired position or professional title"},
+                            "contacts": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "label": {"type": "string"},
+                                        "value": {"type": "string"},
+                                    },
+                                    "required": ["label", "value"],
+                                },
+                            },
+                            "summary": {"type": "string"},
+                            "sections": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "title": {"type": "string"},
+                                        "entries": {
+                                            "type": "array",
+                                            "items": {
+                                                "type": "object",
+                                                "properties": {
+                                                    "title": {"type": "string"},
+                                                    "subtitle": {"type": "string"},
+                                                    "period": {"type": "string"},
+                                                    "bullets": {"type": "array", "items": {"type": "string"}},
+                                                },
+                                            },
+                                        },
+                                    },
+                                    "required": ["title", "entries"],
+                                },
+                            },
+                        },
+                        "required": ["full_name", "sections"],
+                    }
+                }
+            }],
+        )
+
+        message: ChatCompletionMessage = completion.choices[0].message
+
+        if completion.choices[0].message.tool_calls:
+            for call in message.tool_calls:
+                return json.loads(call.function.arguments)
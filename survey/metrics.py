@@ -0,0 +1,192 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from typing import BinaryIO, Callable, Iterator, Optional
+
+import redis
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, make_wsgi_app, multiprocess, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_PORT: int = int(os.environ.get("METRICS_PORT", 9100))
+METRICS_WORKER_PORT: int = int(os.environ.get("METRICS_WORKER_PORT", 9101))
+METRICS_QUEUE_SAMPLE: int = int(os.environ.get("METRICS_QUEUE_SAMPLE", 1_000))
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUERY_BUCKETS: tuple[float, ...] = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+HANDLER_SECONDS = Histogram(
+    "survey_handler_seconds", "Bot handler latency", ["handler"], buckets=LATENCY_BUCKETS
+)
+HANDLER_ERRORS = Counter("survey_handler_errors_total", "Bot handler exceptions", ["handler"])
+
+GPT_SECONDS = Histogram(
+    "survey_gpt_question_seconds", "GPT.get_question latency including tool calls", ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+GPT_TOKENS = Counter("survey_gpt_question_tokens_total", "Tokens spent by GPT.get_question", ["model"])
+
+DB_QUERIES_PER_UPDATE = Histogram(
+    "survey_db_queries_per_update", "Statements executed while processing one update", buckets=QUERY_BUCKETS
+)
+DB_SECONDS_PER_UPDATE = Histogram(
+    "survey_db_seconds_per_update", "Time spent in statements while processing one update", buckets=LATENCY_BUCKETS
+)
+
+STORAGE_SECONDS = Histogram(
+    "survey_storage_seconds", "MinIO call latency, get - until the response headers", ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+STORAGE_BYTES = Counter("survey_storage_bytes_total", "Bytes sent to and announced by MinIO", ["operation"])
+
+TASK_SECONDS = Histogram(
+    "survey_task_seconds", "Celery task run time", ["task", "state"], buckets=LATENCY_BUCKETS
+)
+TASK_RETRIES = Counter("survey_task_retries_total", "Celery task retries", ["task"])
+
+_updates = threading.local()
+_tasks_started: dict[str, float] = {}
+
+
+def serve(port: int):
+    if not port:
+        return
+
+    start_http_server(port)
+    logging.info(f"metrics listening on :{port}")
+
+
+def wsgi_app() -> Callable:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return make_wsgi_app(REGISTRY)
+
+    # gunicorn workers write their samples to the shared directory, any of them serves the sum
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return make_wsgi_app(registry)
+
+
+def timed_handler(function: Callable) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started: float = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(function.__name__).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(function.__name__).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_engine(engine: Engine):
+    # the start lives on the statement's execution context: a failed statement skips after_cursor_execute
+    # and its context is dropped with it, nothing is left on the pooled connection
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started: Optional[float] = getattr(context, "metrics_started", None)
+        if started is None or getattr(_updates, "queries", None) is None:
+            return
+
+        _updates.queries += 1
+        _updates.seconds += time.perf_counter() - started
+
+
+def start_update():
+    _updates.queries, _updates.seconds = 0, 0.0
+
+
+def finish_update():
+    if getattr(_updates, "queries", None) is None:
+        return
+
+    DB_QUERIES_PER_UPDATE.observe(_updates.queries)
+    DB_SECONDS_PER_UPDATE.observe(_updates.seconds)
+    _updates.queries = None
+
+
+class CountingReader:
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self.size: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data: bytes = self._stream.read(size)
+        self.size += len(data)
+        return data
+
+
+def task_started(task_id: str):
+    _tasks_started[task_id] = time.perf_counter()
+
+
+def task_finished(task_id: str, task_name: str, state: Optional[str]):
+    started: Optional[float] = _tasks_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(_short_name(task_name), state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+def task_retried(task_name: str):
+    TASK_RETRIES.labels(_short_name(task_name)).inc()
+
+
+def _short_name(task_name: str) -> str:
+    return task_name.rsplit(".", 1)[-1]
+
+
+class QueueCollector:
+    def __init__(self, broker_url: str, queues: list[str]):
+        self._redis = redis.Redis.from_url(broker_url)
+        self._queues = queues
+
+    @staticmethod
+    def _families() -> tuple[GaugeMetricFamily, GaugeMetricFamily]:
+        return (
+            GaugeMetricFamily("survey_celery_queue_depth", "Messages waiting in the broker queue", labels=["queue"]),
+            GaugeMetricFamily(
+                "survey_celery_queued_tasks",
+                "Waiting messages by task, counted over the oldest METRICS_QUEUE_SAMPLE of every queue",
+                labels=["task"],
+            ),
+        )
+
+    def describe(self) -> Iterator[GaugeMetricFamily]:
+        # keeps the registration from querying the broker
+        yield from self._families()
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        depth, queued = self._families()
+
+        counts: dict[str, int] = {}
+        try:
+            for queue in self._queues:
+                depth.add_metric([queue], self._redis.llen(queue))
+                # kombu pushes to the head, the oldest messages are at the tail
+                for raw in self._redis.lrange(queue, -METRICS_QUEUE_SAMPLE, -1):
+                    task: str = _short_name(json.loads(raw).get("headers", {}).get("task") or "unknown")
+                    counts[task] = counts.get(task, 0) + 1
+        except (redis.RedisError, ValueError):
+            logging.exception("Failed to collect queue depth")
+            return
+
+        for task, count in counts.items():
+            queued.add_metric([task], count)
+
+        yield depth
+        yield queued
+
+
+def register_queues(broker_url: str, queues: list[str]):
+    REGISTRY.register(QueueCollector(broker_url, queues))
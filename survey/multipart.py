@@ -0,0 +1,73 @@
+import collections
+from typing import BinaryIO, Iterable, Union
+
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+
+
+class MultipartBody:
+    def __init__(self, fields: dict, files: dict[str, tuple[str, BinaryIO, int, str]]):
+        self.boundary: str = choose_boundary()
+        self._segments: collections.deque[Union[bytes, BinaryIO]] = collections.deque()
+        self._length: int = 0
+
+        for name, value in fields.items():
+            for item in _as_list(value):
+                if item is not None:
+                    self._add_part(RequestField(name, item), item if isinstance(item, bytes) else str(item).encode())
+
+        for name, (filename, stream, size, content_type) in files.items():
+            self._add_part(RequestField(name, b"", filename=filename), stream, size, content_type)
+
+        self._add(f"--{self.boundary}--\r\n".encode())
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        result = bytearray()
+
+        while self._segments and (size < 0 or len(result) < size):
+            segment: Union[bytes, BinaryIO] = self._segments[0]
+            wanted: int = -1 if size < 0 else size - len(result)
+
+            if isinstance(segment, bytes):
+                chunk: bytes = segment if wanted < 0 else segment[:wanted]
+                if len(chunk) < len(segment):
+                    self._segments[0] = segment[len(chunk):]
+                else:
+                    self._segments.popleft()
+            else:
+                chunk = segment.read(wanted)
+                if not chunk:
+                    self._segments.popleft()
+
+            result += chunk
+
+        return bytes(result)
+
+    def _add_part(
+            self, field: RequestField, data: Union[bytes, BinaryIO], size: int = None, content_type: str = None
+    ):
+        field.make_multipart(content_type=content_type)
+        self._add(f"--{self.boundary}\r\n".encode() + field.render_headers().encode())
+
+        if isinstance(data, bytes):
+            self._add(data)
+        else:
+            self._segments.append(data)
+            self._length += size
+
+        self._add(b"\r\n")
+
+    def _add(self, data: bytes):
+        self._segments.append(data)
+        self._length += len(data)
+
+
+def _as_list(value) -> Iterable:
+    return value if isinstance(value, (list, tuple)) else [value]
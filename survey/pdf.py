@@ -0,0 +1,194 @@
+import logging
+import os
+import queue
+import struct
+import subprocess
+import sys
+import threading
+from typing import BinaryIO, Optional
+
+PDF_WORKERS: int = int(os.environ.get("PDF_WORKERS", 2))
+PDF_WORKER_MAX_JOBS: int = int(os.environ.get("PDF_WORKER_MAX_JOBS", 200))
+PDF_TIMEOUT: float = float(os.environ.get("PDF_TIMEOUT", 60))
+
+# runs as a plain script, so a render process does not import the survey package,
+# -P keeps the survey directory off sys.path where its modules would shadow top-level ones
+WORKER_FP: str = os.path.abspath(__file__)
+
+_pool: Optional["RenderPool"] = None
+_pool_lock = threading.Lock()
+
+
+def _frame(payload: bytes) -> bytes:
+    return struct.pack(">I", len(payload)) + payload
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data: bytes = b""
+    while len(data) < size:
+        chunk: bytes = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("render process closed its output")
+        data += chunk
+    return data
+
+
+def _read_frame(stream: BinaryIO) -> bytes:
+    return _read_exact(stream, struct.unpack(">I", _read_exact(stream, 4))[0])
+
+
+class RenderWorker:
+    def __init__(self):
+        # stderr is inherited: engine warnings end up in the worker log
+        self.process = subprocess.Popen(
+            [sys.executable, "-P", WORKER_FP], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.jobs: int = 0
+
+    def render(self, html: str, timeout: float) -> bytes:
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            self.process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            self.process.stdin.write(_frame(html.encode("utf-8")))
+            self.process.stdin.flush()
+            status: bytes = _read_exact(self.process.stdout, 1)
+            payload: bytes = _read_frame(self.process.stdout)
+        except (OSError, EOFError) as e:
+            if timed_out.is_set():
+                raise TimeoutError(f"pdf render took longer than {timeout}s") from e
+            raise
+        finally:
+            timer.cancel()
+
+        self.jobs += 1
+        if status != b"O":
+            raise RuntimeError(f"pdf render failed: {payload.decode('utf-8', errors='replace')}")
+
+        return payload
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class RenderPool:
+    def __init__(self, size: int = PDF_WORKERS, max_jobs: int = PDF_WORKER_MAX_JOBS):
+        self._max_jobs = max_jobs
+        # idle workers, a render waits here until one is free; None is a slot whose process failed to start
+        self._idle: queue.Queue[Optional[RenderWorker]] = queue.Queue()
+        for __ in range(size):
+            self._idle.put(self._spawn())
+
+    def render(self, html: str, timeout: float = PDF_TIMEOUT) -> bytes:
+        try:
+            worker: Optional[RenderWorker] = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"no free pdf render process within {timeout}s")
+
+        if worker is None:
+            worker = self._spawn()
+            if worker is None:
+                # the slot stays in the pool, the next render tries to start it again
+                self._idle.put(None)
+                raise RuntimeError("failed to start a pdf render process")
+
+        try:
+            return worker.render(html, timeout)
+        except (OSError, EOFError, TimeoutError):
+            # the process is dead or in an unknown state, it is replaced below
+            worker.jobs = self._max_jobs
+            raise
+        finally:
+            if worker.jobs >= self._max_jobs:
+                # recycled to bound the memory a long-lived renderer accumulates
+                worker.close()
+                worker = self._spawn()
+            self._idle.put(worker)
+
+    @staticmethod
+    def _spawn() -> Optional[RenderWorker]:
+        try:
+            return RenderWorker()
+        except Exception:
+            logging.exception("Failed to start a pdf render process")
+            return None
+
+    def close(self):
+        while not self._idle.empty():
+            worker: Optional[RenderWorker] = self._idle.get_nowait()
+            if worker is not None:
+                worker.close()
+
+
+def get_pool() -> RenderPool:
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = RenderPool()
+
+    return _pool
+
+
+def close_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def _reset_after_fork():
+    global _pool, _pool_lock
+
+    # the parent keeps its render processes, a child starts its own
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def render(html: str, timeout: float = PDF_TIMEOUT) -> bytes:
+    return get_pool().render(html, timeout)
+
+
+def serve():
+    from weasyprint import HTML
+
+    jobs, results = sys.stdin.buffer, sys.stdout.buffer
+    # nothing but results may reach the pipe
+    sys.stdout = sys.stderr
+
+    # fonts and the default stylesheets are loaded once, before the first real document
+    HTML(string="<p>warm up</p>").write_pdf()
+
+    while True:
+        try:
+            html: bytes = _read_frame(jobs)
+        except EOFError:
+            return
+
+        try:
+            status, payload = b"O", HTML(string=html.decode("utf-8")).write_pdf()
+        except Exception as e:
+            status, payload = b"E", repr(e).encode("utf-8")
+
+        results.write(status + _frame(payload))
+        results.flush()
+
+
+if __name__ == '__main__':
+    serve()
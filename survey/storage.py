@@ -1,24 +1,63 @@
 import io
 import os
+import threading
 import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
 
+import urllib3
 from minio import Minio, S3Error
 
+from survey import metrics
+
 MINIO_URL = os.environ.get('MINIO_URL', 'minio:9000')
 MINIO_ACCESS_KEY = os.environ.get('MINIO_ACCESS_KEY', 'minio')
 MINIO_SECRET_KEY = os.environ.get('MINIO_SECRET_KEY', 'minio123')
 
 MINIO_BUCKET_NAME = os.environ.get('MINIO_BUCKET_NAME', 'cvs')
+MINIO_PART_SIZE: int = int(os.environ.get('MINIO_PART_SIZE', 5 * 1024 * 1024))
+MINIO_MAX_CONNECTIONS: int = int(os.environ.get('MINIO_MAX_CONNECTIONS', 10))
+MINIO_TIMEOUT: float = float(os.environ.get('MINIO_TIMEOUT', 60))
+
+_client: Optional[Minio] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Minio:
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Minio(
+                    MINIO_URL,
+                    access_key=MINIO_ACCESS_KEY,
+                    secret_key=MINIO_SECRET_KEY,
+                    secure=False,
+                    http_client=urllib3.PoolManager(
+                        maxsize=MINIO_MAX_CONNECTIONS,
+                        block=True,
+                        timeout=urllib3.Timeout(connect=10, read=MINIO_TIMEOUT),
+                        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+                    ),
+                )
+
+    return _client
+
+
+def _reset_after_fork():
+    global _client, _client_lock
+
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 class MinioClient:
     def __init__(self):
-        self._client = Minio(
-            MINIO_URL,
-            access_key=MINIO_ACCESS_KEY,
-            secret_key=MINIO_SECRET_KEY,
-            secure=False
-        )
+        self._client = get_client()
 
     def create_buckets(self):
         for name in (MINIO_BUCKET_NAME,):
@@ -26,20 +65,40 @@ class MinioClient:
                 self._client.make_bucket(name)
 
     def save(self, file_name: str, data: bytes, content_type: str, size: int) -> str:
+        return self.save_stream(file_name, io.BytesIO(data), content_type, size)
+
+    def save_stream(self, file_name: str, stream: BinaryIO, content_type: str, size: Optional[int] = None) -> str:
         key: str = f"{uuid.uuid4()}_{file_name}"
+        reader = metrics.CountingReader(stream)
 
-        self._client.put_object(
-            bucket_name=MINIO_BUCKET_NAME,
-            object_name=key,
-            data=io.BytesIO(data),
-            length=size,
-            content_type=content_type
-        )
+        # one part at a time: at most MINIO_PART_SIZE bytes of the stream are held in memory
+        with metrics.STORAGE_SECONDS.labels("put").time():
+            self._client.put_object(
+                bucket_name=MINIO_BUCKET_NAME,
+                object_name=key,
+                data=reader,
+                length=-1 if size is None else size,
+                content_type=content_type,
+                part_size=MINIO_PART_SIZE,
+                num_parallel_uploads=1,
+            )
+        metrics.STORAGE_BYTES.labels("put").inc(reader.size)
 
         return key
 
-    def get(self, key: str):
+    @contextmanager
+    def open(self, key: str) -> Iterator[Optional[urllib3.BaseHTTPResponse]]:
         try:
-            return self._client.get_object(MINIO_BUCKET_NAME, key)
+            with metrics.STORAGE_SECONDS.labels("get").time():
+                response = self._client.get_object(MINIO_BUCKET_NAME, key)
         except S3Error:
-            return None
+            yield None
+            return
+
+        metrics.STORAGE_BYTES.labels("get").inc(int(response.headers.get("Content-Length") or 0))
+
+        try:
+            yield response
+        finally:
+            response.close()
+            response.release_conn()
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional, Union
 
 from . import db, gpt, tasks, utils
@@ -16,6 +16,36 @@ class Param:
     value: Optional[str] = None
 
 
+@dataclass
+class History:
+    budget: int
+    token_budget: int
+    entries: list[db.Message] = field(default_factory=list)
+    size: int = 0
+    tokens: int = 0
+
+    @property
+    def messages(self) -> list[dict]:
+        return [entry.data for entry in self.entries]
+
+    def append(self, entry: db.Message):
+        self.entries.append(entry)
+        self.size += entry.size
+        self.tokens += entry.tokens
+        self.trim(self.budget, self.token_budget)
+
+    def trim(self, budget: int, token_budget: int):
+        self.budget, self.token_budget = budget, token_budget
+
+        drop: int = 0
+        while drop < len(self.entries) and (self.size >= budget or self.tokens >= token_budget):
+            self.size -= self.entries[drop].size
+            self.tokens -= self.entries[drop].tokens
+            drop += 1
+
+        del self.entries[:drop]
+
+
 @dataclass
 class UserSurvey:
     tg_chat_id: str
@@ -25,28 +55,98 @@ class UserSurvey:
 
     _lang: Union[Optional[str], bool] = None
 
+    _snapshot: Optional[dict] = None
+    _dirty: set[str] = field(default_factory=set)
+    _pending_messages: list[db.Message] = field(default_factory=list)
+    _window: Optional[History] = None
+    _reserved_tokens: int = 0
+    _spent_tokens: Optional[int] = None
+
+    def load(self) -> bool:
+        snapshot: Optional[dict] = self._db.get_user_snapshot(self.tg_chat_id)
+        self._snapshot = snapshot or {"data": {}, "tg_data": {}, "lang": None, "tokens": None}
+        self._dirty.clear()
+        self._pending_messages.clear()
+        self._window = None
+
+        if self._lang is None:
+            self._lang = self._snapshot["lang"] or False
+
+        return snapshot is not None
+
+    def flush(self):
+        if self._snapshot is None:
+            return
+
+        if self._pending_messages:
+            self._db.add_messages(self.tg_chat_id, self._pending_messages)
+            self._pending_messages = []
+
+        if self._dirty:
+            data: dict = self._snapshot["data"]
+            self._db.update_chat_data(self.tg_chat_id, {key: data.get(key) for key in self._dirty})
+            self._dirty.clear()
+
     @property
     def _data(self) -> dict:
+        if self._snapshot is not None:
+            return self._snapshot["data"]
+
         return self._db.get_chat_data(self.tg_chat_id) or {}
 
+    def _save(self, data: dict, *keys: str):
+        if self._snapshot is not None:
+            self._dirty.update(keys)
+            return
+
+        self._db.set_chat_data(self.tg_chat_id, data, params_changed="params" in keys)
+
     @property
     def _tg_username(self) -> Optional[str]:
-        return (self._db.get_tg_data(self.tg_chat_id) or {}).get(db.TgParam.username.value)
+        tg_data: Optional[dict] = (
+            self._snapshot["tg_data"] if self._snapshot is not None else self._db.get_tg_data(self.tg_chat_id)
+        )
+        return (tg_data or {}).get(db.TgParam.username.value)
 
     def get_tg_username(self) -> Optional[str]:
         return self._tg_username
 
     def get_tokens(self) -> int:
-        return self._data.get("tokens") or self._start_tokens
+        tokens: Optional[int] = (
+            self._snapshot["tokens"] if self._snapshot is not None else self._db.get_tokens(self.tg_chat_id)
+        )
+        return self._start_tokens if tokens is None else tokens
 
     def deduct_tokens(self, tokens: int):
-        data: dict = self._data
-        if "tokens" not in data:
-            data["tokens"] = self._start_tokens
+        if self._spent_tokens is not None:
+            self._spent_tokens += tokens
+            return
+
+        self._set_tokens(self._db.change_tokens(
+            self.tg_chat_id, -tokens, self._start_tokens, "topup" if tokens < 0 else "spend"
+        ))
+
+    def reserve_tokens(self, tokens: int) -> bool:
+        left: Optional[int] = self._db.reserve_tokens(self.tg_chat_id, tokens, self._start_tokens)
+        if left is None:
+            return False
+
+        self._set_tokens(left)
+        self._reserved_tokens, self._spent_tokens = tokens, 0
+        return True
 
-        data["tokens"] -= tokens
+    def settle_tokens(self):
+        if self._spent_tokens is None:
+            return
 
-        self._db.set_chat_data(self.tg_chat_id, data)
+        reserved, spent = self._reserved_tokens, self._spent_tokens
+        self._reserved_tokens, self._spent_tokens = 0, None
+
+        self._set_tokens(self._db.settle_tokens(self.tg_chat_id, reserved, spent, "spend"))
+
+    def _set_tokens(self, tokens: Optional[int]):
+        if self._snapshot is not None and tokens is not None:
+            self._snapshot["tokens"] = tokens
 
     def get_params(self) -> list[Param]:
         data: dict = self._data
@@ -67,10 +167,29 @@ class UserSurvey:
 
         data["params"][str(ind)] = value
 
-        self._db.set_chat_data(self.tg_chat_id, data)
+        self._save(data, "params")
+
+    def get_history_window(self, budget: int, token_budget: int) -> History:
+        window: Optional[History] = self._window
+        if window is not None and budget <= window.budget and token_budget <= window.token_budget:
+            window.trim(budget, token_budget)
+            return window
+
+        window = History(budget=budget, token_budget=token_budget)
+        pending_size: int = sum(entry.size for entry in self._pending_messages)
+        pending_tokens: int = sum(entry.tokens for entry in self._pending_messages)
 
-    def get_history(self) -> list[dict]:
-        return self._data.get("messages") or []
+        stored: list[db.Message] = []
+        if pending_size < budget and pending_tokens < token_budget:
+            stored = self._db.get_messages_window(
+                self.tg_chat_id, budget - pending_size, token_budget - pending_tokens
+            )
+
+        for entry in [*stored, *self._pending_messages]:
+            window.append(entry)
+
+        self._window = window
+        return window
 
     def add_user_answer(self, text: str):
         self._add_message_by_role(gpt.GPT.Role.USER.value, text)
@@ -79,12 +198,16 @@ class UserSurvey:
         self._add_message({"role": role, "content": text})
 
     def _add_message(self, message: dict):
-        data: dict = self._data
-        if "messages" not in data:
-            data["messages"] = []
+        entry: db.Message = db.new_message(message)
+
+        if self._window is not None:
+            self._window.append(entry)
+
+        if self._snapshot is not None:
+            self._pending_messages.append(entry)
+            return
 
-        data["messages"].append(message)
-        self._db.set_chat_data(self.tg_chat_id, data)
+        self._db.add_messages(self.tg_chat_id, [entry])
 
     def add_assistant_question(self, text):
         self._add_message_by_role(gpt.GPT.Role.ASSISTANT.value, text)
@@ -102,7 +225,7 @@ class UserSurvey:
         data: dict = self._data
         data["vacancy"] = value
 
-        self._db.set_chat_data(self.tg_chat_id, data)
+        self._save(data, "vacancy")
 
     def get_resume_key(self) -> Optional[str]:
         return self._data.get("resume")
@@ -111,9 +234,19 @@ class UserSurvey:
         data: dict = self._data
         data["resume"] = value
 
-        self._db.set_chat_data(self.tg_chat_id, data)
+        self._save(data, "resume")
+
+    def get_pending_resume(self) -> Optional[str]:
+        return self._data.get("resume_pending")
+
+    def set_pending_resume(self, file_id: Optional[str]):
+        data: dict = self._data
+        data["resume_pending"] = file_id
+
+        self._save(data, "resume_pending")
 
     def send_short_to_crm(self):
+        self.flush()
         tasks.integrate_with_crm.delay(self.tg_chat_id, {
             "telegram_username": self._tg_username,
             "position": self.get_vacancy(),
@@ -121,6 +254,7 @@ class UserSurvey:
         }, self.get_resume_key() or None)
 
     def send_full_to_crm(self):
+        self.flush()
         tasks.finish_survey.delay(self.tg_chat_id)
 
     def translate(self, text: str) -> str:
@@ -0,0 +1,35 @@
+import functools
+import os
+from typing import Optional
+
+import tiktoken
+
+GPT_MODEL_NAME = os.environ.get("GPT_MODEL_NAME", "gpt-4o")
+FALLBACK_ENCODING = "o200k_base"
+
+TOKENS_PER_MESSAGE: int = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_tokens(text: Optional[str], model: str = GPT_MODEL_NAME) -> int:
+    if not text:
+        return 0
+
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def message_tokens(message: dict) -> int:
+    tokens: int = TOKENS_PER_MESSAGE + count_tokens(message.get("content"))
+
+    for call in message.get("tool_calls") or []:
+        function: dict = call.get("function") or {}
+        tokens += count_tokens(function.get("name")) + count_tokens(function.get("arguments"))
+
+    return tokens
@@ -0,0 +1,145 @@
+import argparse
+import hmac
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import Callable, Iterable, Optional
+from wsgiref.simple_server import make_server
+
+import telebot
+from telebot import types
+from telebot.handler_backends import BaseMiddleware
+
+import main
+from survey import db, metrics
+
+WEBHOOK_URL: Optional[str] = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH: str = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET: str = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS: int = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+WEBHOOK_CLAIM_TTL: int = int(os.environ.get("WEBHOOK_CLAIM_TTL", 300))
+
+
+_updates = threading.local()
+
+
+class HandlerExceptionHandler(telebot.ExceptionHandler):
+    def handle(self, exception: Exception) -> bool:
+        if not getattr(_updates, "handlers_started", False):
+            # nothing reached the user yet, process_update releases the claim for a redelivery
+            return False
+
+        # a handler may have sent replies and spent tokens already, a redelivery would repeat them:
+        # the error is logged, post_process still flushes the user and the update stays processed
+        logging.exception("Handler failed")
+        return True
+
+
+class HandlersStartedMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, obj, data):
+        # runs after LangMiddleware.pre_process, right before the handlers
+        _updates.handlers_started = True
+
+    def post_process(self, obj, data, exception):
+        pass
+
+
+bot = main.create_bot()
+bot.exception_handler = HandlerExceptionHandler()
+bot.setup_middleware(HandlersStartedMiddleware())
+metrics_app: Callable = metrics.wsgi_app()
+
+
+def app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    method: str = environ["REQUEST_METHOD"]
+    path: str = environ.get("PATH_INFO", "")
+
+    if method == "GET" and path == "/health":
+        return _respond(start_response, "200 OK")
+
+    if method == "GET" and path == "/metrics":
+        return metrics_app(environ, start_response)
+
+    if method != "POST" or path != WEBHOOK_PATH:
+        return _respond(start_response, "404 Not Found")
+
+    secret: str = environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN", "")
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return _respond(start_response, "403 Forbidden")
+
+    body: bytes = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+    try:
+        update: types.Update = types.Update.de_json(body.decode("utf-8"))
+    except Exception:
+        logging.exception("Failed to parse update")
+        return _respond(start_response, "400 Bad Request")
+
+    # telegram redelivers the update on any other status
+    return _respond(start_response, process_update(update))
+
+
+def process_update(update: types.Update) -> str:
+    claim: db.Claim = main.my_db.claim_update(update.update_id, timedelta(seconds=WEBHOOK_CLAIM_TTL))
+    if claim == db.Claim.PROCESSED:
+        logging.info(f"Skip already processed update_id={update.update_id}")
+        return "200 OK"
+    if claim == db.Claim.PROCESSING:
+        # another replica is on it, if it fails the redelivery is processed here
+        logging.info(f"Postpone update_id={update.update_id} processed by another replica")
+        return "503 Service Unavailable"
+
+    _updates.handlers_started = False
+    try:
+        bot.process_new_updates([update])
+    except Exception:
+        # only failures before the handlers get here
+        logging.exception(f"Failed to process update_id={update.update_id}")
+        main.my_db.release_update(update.update_id)
+        return "500 Internal Server Error"
+
+    main.my_db.complete_update(update.update_id)
+    return "200 OK"
+
+
+def _respond(start_response: Callable, status: str) -> Iterable[bytes]:
+    start_response(status, [("Content-Type", "text/plain"), ("Content-Length", "0")])
+    return [b""]
+
+
+def set_webhook():
+    assert WEBHOOK_URL, "WEBHOOK_URL is required"
+
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=["message", "callback_query"],
+    )
+    logging.info(f"webhook set to {WEBHOOK_URL}")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Telegram webhook entry point")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run a single-threaded development server")
+    serve.add_argument("--port", type=int, default=8080)
+
+    commands.add_parser("set", help="register WEBHOOK_URL in telegram")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        logging.info(f"webhook listening on :{args.port}{WEBHOOK_PATH}")
+        make_server("", args.port, app).serve_forever()
+    elif args.command == "set":
+        set_webhook()
+
+
+if __name__ == '__main__':
+    cli()